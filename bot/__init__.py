@@ -1,2 +1,6 @@
 
 # Bot Package
+
+# Event loop the bot runs on and the id of its thread; set by core.run_bot()
+LOOP = None
+LOOP_THREAD = None
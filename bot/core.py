@@ -2,79 +2,184 @@
 import logging
 import os
 import asyncio
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
-from bot import handlers
-from database import get_db, Variable
-from sqlalchemy import select
+import inspect
+import threading
+from dataclasses import dataclass
+from typing import Optional, TYPE_CHECKING
+import bot
+from database import Variable, db_session, warm_pool
+from sqlalchemy import select, bindparam
 
-# Configure logging
+# telegram.ext (and the handlers that pull it in) is imported inside run_bot(),
+# so importing this module does not load PTB until the bot actually starts
+if TYPE_CHECKING:
+    from telegram import Bot
+    from telegram.ext import Application
+
+# Configure logging: INFO for the bot's own loggers, WARNING for libraries
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=logging.WARNING
 )
+# The app's own modules; "__main__" covers main.py started directly
+for _name in ("bot", "cleanup", "database", "main", "__main__"):
+    logging.getLogger(_name).setLevel(logging.INFO)
+for _name in ("httpx", "telegram", "sqlalchemy", "uvicorn.access"):
+    logging.getLogger(_name).setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Token placeholder - In production this should come from ENV or Config
 BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
-bot_app = None # Global access to bot
+
+@dataclass(frozen=True, slots=True)
+class BotCtx:
+    """The running Application and its Bot, bound once at startup."""
+    app: "Application"
+    bot: "Bot"
+
+ctx: Optional[BotCtx] = None # Set by run_bot() once the bot is built
+
+# Long polling: Telegram holds each getUpdates request for up to POLL_TIMEOUT
+# seconds, and the local loop waits POLL_INTERVAL between requests
+POLL_INTERVAL = 0.1
+POLL_TIMEOUT = 30
+
+# Outgoing Bot API calls share one HTTP/2 client so concurrent sends (e.g.
+# broadcasts) multiplex over a few connections instead of one per request
+CONNECTION_POOL_SIZE = 100
+POOL_TIMEOUT = 5.0
+
+# Bot API calls are throttled to Telegram's global limit (group chats also get
+# PTB's default 20/min); a RetryAfter is waited out and retried this many times
+RATE_LIMIT_PER_SECOND = 30
+RATE_LIMIT_RETRIES = 3
+
+# Webhook mode: set WEBHOOK_URL to the public HTTPS URL Telegram should push
+# updates to; the updater then listens on WEBHOOK_LISTEN:WEBHOOK_PORT instead
+# of long polling. Leave it unset to keep polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Only the update types the registered handlers consume
+ALLOWED_UPDATES = ["message", "callback_query"] # Update.MESSAGE, Update.CALLBACK_QUERY
+
+def _build_handlers():
+    """Return the handlers to register, importing PTB and bot.handlers on first use."""
+    from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler
+    from bot import handlers
+
+    return (
+        CommandHandler("start", handlers.start_command),
+        CommandHandler("help", handlers.help_command),
+        CommandHandler("lang", handlers.lang_command),
+        CommandHandler("stats", handlers.stats_command),
+
+        # Admin Commands
+        CommandHandler("admin", handlers.admin_command),
+        CommandHandler("broadcast", handlers.broadcast_command),
+        CommandHandler("ban", handlers.ban_command),
+        CommandHandler("unban", handlers.unban_command),
+        CommandHandler("promote", handlers.promote_command),
+        CommandHandler("demote", handlers.demote_command),
+
+        # Variable Management Commands
+        CommandHandler("setvar", handlers.setvar_command),
+        CommandHandler("getvar", handlers.getvar_command),
+        CommandHandler("delvar", handlers.delvar_command),
+
+        # Message Handler for URLs
+        MessageHandler(handlers.PlainText(), handlers.handle_message),
+
+        # Callback Query Handler for Buttons
+        CallbackQueryHandler(handlers.button_callback),
+    )
+
+# Built once so SQLAlchemy reuses the compiled form on every lookup
+_TOKEN_STMT = select(Variable.value).where(Variable.key == bindparam("k"))
 
 async def load_token_from_db():
     """Try to load token from DB if not in ENV"""
     global BOT_TOKEN
-    if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
-        async for session in get_db():
-            result = await session.execute(select(Variable).where(Variable.key == "BOT_TOKEN"))
-            var = result.scalar_one_or_none()
-            if var:
-                BOT_TOKEN = var.value
-                logger.info("Bot token loaded from database.")
-            else:
-                logger.warning("Bot token not found in ENV or Database!")
+    # Already resolved (ENV or an earlier run): skip the DB round trip
+    if BOT_TOKEN != "YOUR_BOT_TOKEN_HERE":
+        return
+
+    async with db_session() as session:
+        token = await session.scalar(_TOKEN_STMT, {"k": "BOT_TOKEN"})
+
+    if token:
+        BOT_TOKEN = token
+        logger.info("Bot token loaded from database.")
+    else:
+        logger.warning("Bot token not found in ENV or Database!")
 
 async def run_bot():
-    """Start the bot."""
+    """Start the bot.
+
+    Runs as a task on the server's event loop, so the Application uses
+    whatever loop uvicorn started (uvloop when it is installed).
+    """
     await load_token_from_db()
     
     if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
         logger.error("No valid BOT_TOKEN found. Bot will not start.")
         return
 
-    global bot_app
-    bot_app = Application.builder().token(BOT_TOKEN).build()
-    application = bot_app
+    from telegram.ext import AIORateLimiter, Application
+    from bot import handlers
+    from bot.request import OrjsonRequest
+
+    handler_list = _build_handlers()
+
+    # PTB awaits callbacks as-is, so a sync one would only fail on its first update
+    callbacks = [h.callback for h in handler_list] + [handlers.error_handler]
+    sync_callbacks = [cb.__name__ for cb in callbacks if not inspect.iscoroutinefunction(cb)]
+    if sync_callbacks:
+        logger.error("Handlers must be async def, got sync: %s", ", ".join(sync_callbacks))
+        return
+
+    global ctx
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(OrjsonRequest(
+            http_version="2",
+            connection_pool_size=CONNECTION_POOL_SIZE,
+            pool_timeout=POOL_TIMEOUT,
+        ))
+        .get_updates_request(OrjsonRequest(http_version="2"))
+        .rate_limiter(AIORateLimiter(overall_max_rate=RATE_LIMIT_PER_SECOND, max_retries=RATE_LIMIT_RETRIES))
+        .build()
+    )
+    ctx = BotCtx(app=application, bot=application.bot)
 
     # Register Handlers
-    application.add_handler(CommandHandler("start", handlers.start_command))
-    application.add_handler(CommandHandler("help", handlers.help_command))
-    application.add_handler(CommandHandler("lang", handlers.lang_command))
-    application.add_handler(CommandHandler("stats", handlers.stats_command))
-    
-    # Admin Commands
-    application.add_handler(CommandHandler("admin", handlers.admin_command))
-    application.add_handler(CommandHandler("broadcast", handlers.broadcast_command))
-    application.add_handler(CommandHandler("ban", handlers.ban_command))
-    application.add_handler(CommandHandler("unban", handlers.unban_command))
-    application.add_handler(CommandHandler("promote", handlers.promote_command))
-    application.add_handler(CommandHandler("demote", handlers.demote_command))
-    
-    # Variable Management Commands
-    application.add_handler(CommandHandler("setvar", handlers.setvar_command))
-    application.add_handler(CommandHandler("getvar", handlers.getvar_command))
-    application.add_handler(CommandHandler("delvar", handlers.delvar_command))
-    
-    # Message Handler for URLs
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.handle_message))
-    
-    # Callback Query Handler for Buttons
-    application.add_handler(CallbackQueryHandler(handlers.button_callback))
+    application.add_handlers(handler_list)
 
     # Error Handler
     application.add_error_handler(handlers.error_handler)
 
-    # Initialize and start
-    await application.initialize()
+    # Initialize and start; warming the DB pool is independent of the
+    # application, so it overlaps initialize()'s getMe round trip
+    await asyncio.gather(application.initialize(), warm_pool())
+    bot.LOOP = asyncio.get_running_loop()
+    bot.LOOP_THREAD = threading.get_ident()
     await application.start()
-    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
-    
-    logger.info("Bot started successfully.")
+    if WEBHOOK_URL:
+        await application.updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        logger.info("Bot started successfully (webhook on port %s).", WEBHOOK_PORT)
+    else:
+        await application.updater.start_polling(
+            poll_interval=POLL_INTERVAL,
+            timeout=POLL_TIMEOUT,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        logger.info("Bot started successfully (polling).")
@@ -2,64 +2,133 @@ import logging
 import os
 import asyncio
 import re
-import json
 import time
-from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, MessageOrigin
-from telegram.constants import ParseMode, ChatAction
-from telegram.ext import ContextTypes
-from telegram.helpers import escape_markdown
-from sqlalchemy import select, update
-from sqlalchemy.orm import Session
+import threading
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Any, NamedTuple, Optional, Tuple
+import aiofiles
+from cachetools import TTLCache
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode, ChatAction, ChatType
+from telegram.error import BadRequest, NetworkError
+from telegram.ext import ContextTypes, filters
+from sqlalchemy import select, update, func, bindparam
 
 # Local imports
-from database import get_db, User, Variable, DownloadHistory
+import bot
+from database import db_session, dialect_insert, log_download, complete_download, User, Variable, DownloadHistory, DownloadCounter
 from locales import t
 import main  # To access internal_download_video
 
 logger = logging.getLogger(__name__)
 
-# Advanced animation and reaction constants
-REACTIONS = {
-    "searching": ["🔍", "👀", "🔎", "💫"],
-    "downloading": ["⬇️", "📥", "⚡", "💾"],
-    "uploading": ["🚀", "📤", "☁️", "✨"],
-    "processing": ["⚙️", "🔄", "💭", "⏳"],
-    "success": ["✅", "🎉", "🌟", "🎊"],
-    "error": ["❌", "💥", "🚫", "⚠️"],
-    "completed": ["🎬", "🎵", "📱", "💎"],
-    "live_download": ["🔄", "⬇️", "📥", "💾"],
-    "live_upload": ["🚀", "📤", "☁️", "✨"],
-    "admin_action": ["👑", "⚙️", "🔧", "💻"]
-}
+class PlainText(filters.MessageFilter):
+    """Text that is not a command; one check instead of TEXT & ~COMMAND."""
+    __slots__ = ()
+
+    def filter(self, message):
+        text = message.text
+        return text is not None and not text.startswith("/")
+
+# Advanced animation and reaction constants (read-only)
+REACTIONS = MappingProxyType({
+    "searching": ("🔍", "👀", "🔎", "💫"),
+    "downloading": ("⬇️", "📥", "⚡", "💾"),
+    "uploading": ("🚀", "📤", "☁️", "✨"),
+    "processing": ("⚙️", "🔄", "💭", "⏳"),
+    "success": ("✅", "🎉", "🌟", "🎊"),
+    "error": ("❌", "💥", "🚫", "⚠️"),
+    "completed": ("🎬", "🎵", "📱", "💎"),
+    "live_download": ("🔄", "⬇️", "📥", "💾"),
+    "live_upload": ("🚀", "📤", "☁️", "✨"),
+    "admin_action": ("👑", "⚙️", "🔧", "💻")
+})
 
 # Animation sequences for different actions
-ANIMATION_SEQUENCES = {
-    "searching": ["🔍", "🔎", "🔍", "🔎"],
-    "downloading": ["⬇️", "📥", "⬇️", "📥"],
-    "uploading": ["🚀", "📤", "🚀", "📤"],
-    "processing": ["⚙️", "🔄", "⚙️", "🔄"],
-    "success": ["✅", "🎉", "✅", "🎉"],
-    "live_download": ["🔄", "⬇️", "📥", "💾"],
-    "live_upload": ["🚀", "📤", "☁️", "✨"]
-}
-
-# Live status tracking
-LIVE_STATUS_MESSAGES = {}
+ANIMATION_SEQUENCES = MappingProxyType({
+    "searching": ("🔍", "🔎", "🔍", "🔎"),
+    "downloading": ("⬇️", "📥", "⬇️", "📥"),
+    "uploading": ("🚀", "📤", "🚀", "📤"),
+    "processing": ("⚙️", "🔄", "⚙️", "🔄"),
+    "success": ("✅", "🎉", "✅", "🎉"),
+    "live_download": ("🔄", "⬇️", "📥", "💾"),
+    "live_upload": ("🚀", "📤", "☁️", "✨")
+})
+
+# Used for status types without a sequence
+_DEFAULT_EMOJIS = ("⚙️",)
+
+# Live status tracking: message_id -> LiveStatus. Entries of abandoned
+# downloads expire on their own instead of accumulating.
+class LiveStatus(NamedTuple):
+    bot: Any
+    chat_id: int
+    message_id: int
+    status_type: str
+
+LIVE_STATUS_MESSAGES = TTLCache(maxsize=10000, ttl=3600)
 
 # --- Advanced Helper Functions ---
+
+# Hot lookups built once so SQLAlchemy reuses their compiled form
+_SEL_USER_BY_TID = select(User).where(User.telegram_id == bindparam("tid"))
+_SEL_USER_STATE = select(User.language, User.is_admin, User.is_banned).where(User.telegram_id == bindparam("tid"))
+_SEL_VAR_BY_KEY = select(Variable).where(Variable.key == bindparam("key"))
+
+class UserState(NamedTuple):
+    """The per-update user flags handlers check before doing anything."""
+    language: str
+    is_admin: bool
+    is_banned: bool
+
+# Returned for users that have no row yet
+DEFAULT_USER_STATE = UserState("fa", False, False)
+
+# Cache of user states so handlers don't hit the database on every update:
+# user_id -> (expires_at, state). Every write to a user's language or flags
+# calls invalidate_user_state(), the TTL only bounds staleness for changes
+# made directly in the database.
+USER_STATE_TTL = float(os.getenv("USER_STATE_TTL", "300"))
+USER_STATE_CACHE_MAX = 10000 # Expired entries are swept once this many are held
+_user_state_cache: Dict[int, Tuple[float, UserState]] = {}
+
+async def fetch_user_state(user_id: int) -> UserState:
+    """Get language, admin and ban status of a user in one query."""
+    now = time.monotonic()
+    cached = _user_state_cache.get(user_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    async with db_session() as session:
+        result = await session.execute(_SEL_USER_STATE, {"tid": user_id})
+        row = result.one_or_none()
+    state = UserState(*row) if row else DEFAULT_USER_STATE
+    _cache_user_state(user_id, state)
+    return state
+
+def _cache_user_state(user_id: int, state: UserState):
+    now = time.monotonic()
+    if len(_user_state_cache) >= USER_STATE_CACHE_MAX:
+        for uid in [uid for uid, (expires, _) in _user_state_cache.items() if expires <= now]:
+            del _user_state_cache[uid]
+        if len(_user_state_cache) >= USER_STATE_CACHE_MAX:
+            # Nothing expired, evict the oldest entry
+            del _user_state_cache[next(iter(_user_state_cache))]
+    _user_state_cache[user_id] = (now + USER_STATE_TTL, state)
+
+def invalidate_user_state(user_id: int):
+    """Drop the cached state after changing a user's language or flags."""
+    _user_state_cache.pop(user_id, None)
+
 async def get_user_lang(user_id: int) -> str:
     """Get user language preference."""
-    async for session in get_db():
-        result = await session.execute(select(User).where(User.telegram_id == user_id))
-        user = result.scalar_one_or_none()
-        return user.language if user else "fa"
+    return (await fetch_user_state(user_id)).language
 
 async def get_user_data(user_id: int) -> Optional[Dict[str, Any]]:
     """Get complete user data."""
-    async for session in get_db():
-        result = await session.execute(select(User).where(User.telegram_id == user_id))
+    async with db_session() as session:
+        result = await session.execute(_SEL_USER_BY_TID, {"tid": user_id})
         user = result.scalar_one_or_none()
         if user:
             return {
@@ -74,88 +143,101 @@ async def get_user_data(user_id: int) -> Optional[Dict[str, Any]]:
             }
     return None
 
-async def register_user(user_info: Update.effective_user):
-    """Register or update user in DB with enhanced data."""
-    async for session in get_db():
-        result = await session.execute(select(User).where(User.telegram_id == user_info.id))
-        existing_user = result.scalar_one_or_none()
-        
-        if not existing_user:
-            new_user = User(
-                telegram_id=user_info.id,
-                username=user_info.username,
-                full_name=user_info.full_name or user_info.first_name,
-                language="fa" # Default to Persian
-            )
-            session.add(new_user)
-        else:
-            # Update info
-            existing_user.username = user_info.username
-            existing_user.full_name = user_info.full_name or user_info.first_name
-            
+async def register_user(user_info: Update.effective_user) -> UserState:
+    """Register or update user in DB and return their state."""
+    stmt = dialect_insert(User).values(
+        telegram_id=user_info.id,
+        username=user_info.username,
+        full_name=user_info.full_name or user_info.first_name,
+        language="fa" # Default to Persian
+    )
+    # Existing users only get their name fields refreshed
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.telegram_id],
+        set_={"username": stmt.excluded.username, "full_name": stmt.excluded.full_name},
+    ).returning(User.language, User.is_admin, User.is_banned)
+    async with db_session() as session:
+        result = await session.execute(stmt)
+        state = UserState(*result.one())
         await session.commit()
+    _cache_user_state(user_info.id, state)
+    return state
 
 async def is_admin(user_id: int) -> bool:
     """Check if user is admin."""
-    async for session in get_db():
-        result = await session.execute(select(User).where(User.telegram_id == user_id))
-        user = result.scalar_one_or_none()
-        return user.is_admin if user else False
+    return (await fetch_user_state(user_id)).is_admin
 
 async def is_banned(user_id: int) -> bool:
     """Check if user is banned."""
-    async for session in get_db():
-        result = await session.execute(select(User).where(User.telegram_id == user_id))
-        user = result.scalar_one_or_none()
-        return user.is_banned if user else False
+    return (await fetch_user_state(user_id)).is_banned
 
 async def set_user_admin(user_id: int, is_admin: bool = True) -> bool:
     """Set user admin status."""
     try:
-        async for session in get_db():
-            result = await session.execute(select(User).where(User.telegram_id == user_id))
+        async with db_session() as session:
+            result = await session.execute(_SEL_USER_BY_TID, {"tid": user_id})
             user = result.scalar_one_or_none()
             if user:
                 user.is_admin = is_admin
                 await session.commit()
+                invalidate_user_state(user_id)
                 return True
         return False
     except Exception as e:
-        logger.error(f"Error setting admin status for user {user_id}: {e}")
+        logger.error("Error setting admin status for user %s: %s", user_id, e)
         return False
 
+async def update_user_flag(telegram_id: int, flag: str, value: bool):
+    """Set a user's is_admin/is_banned flag with one UPDATE ... RETURNING.
+
+    Returns (row, exists): row holds username and full_name when the flag
+    changed, otherwise it is None and exists tells "already set" apart
+    from "no such user".
+    """
+    column = getattr(User, flag)
+    stmt = (
+        update(User)
+        .where(User.telegram_id == telegram_id, column.is_not(value))
+        .values({flag: value})
+        .returning(User.username, User.full_name)
+    )
+    async with db_session() as session:
+        row = (await session.execute(stmt)).first()
+        if row is None:
+            exists = await session.scalar(select(User.id).where(User.telegram_id == telegram_id))
+            return None, exists is not None
+        await session.commit()
+    invalidate_user_state(telegram_id)
+    return row, True
+
 async def get_variable(key: str, default: str = "") -> str:
     """Get variable value from database."""
-    async for session in get_db():
-        result = await session.execute(select(Variable).where(Variable.key == key))
+    async with db_session() as session:
+        result = await session.execute(_SEL_VAR_BY_KEY, {"key": key})
         var = result.scalar_one_or_none()
         return var.value if var else default
 
 async def set_variable(key: str, value: str, description: str = "") -> bool:
     """Set variable value in database."""
+    stmt = dialect_insert(Variable).values(key=key, value=value, description=description)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Variable.key],
+        set_={"value": stmt.excluded.value, "description": stmt.excluded.description},
+    )
     try:
-        async for session in get_db():
-            result = await session.execute(select(Variable).where(Variable.key == key))
-            var = result.scalar_one_or_none()
-            
-            if var:
-                var.value = value
-                var.description = description
-            else:
-                var = Variable(key=key, value=value, description=description)
-                session.add(var)
-            
+        async with db_session() as session:
+            await session.execute(stmt)
             await session.commit()
             return True
     except Exception as e:
-        logger.error(f"Error setting variable {key}: {e}")
+        logger.error("Error setting variable %s: %s", key, e)
         return False
 
 async def delete_variable(key: str) -> bool:
     """Delete variable from database."""
     try:
-        async for session in get_db():
-            result = await session.execute(select(Variable).where(Variable.key == key))
+        async with db_session() as session:
+            result = await session.execute(_SEL_VAR_BY_KEY, {"key": key})
             var = result.scalar_one_or_none()
             if var:
                 await session.delete(var)
@@ -163,30 +245,97 @@ async def delete_variable(key: str) -> bool:
                 return True
         return False
     except Exception as e:
-        logger.error(f"Error deleting variable {key}: {e}")
+        logger.error("Error deleting variable %s: %s", key, e)
         return False
 
+# Users, admins, banned users and total downloads in a single round trip
+_ADMIN_COUNTS = select(
+    func.count().label("total"),
+    func.count().filter(User.is_admin == True).label("admins"),
+    func.count().filter(User.is_banned == True).label("banned"),
+    select(func.count()).select_from(DownloadHistory).scalar_subquery().label("downloads"),
+).select_from(User)
+
+async def get_admin_counts(session):
+    """Return the (total, admins, banned, downloads) counts row."""
+    result = await session.execute(_ADMIN_COUNTS)
+    return result.one()
+
+# Newest downloads, limited to the two columns the admin panels display
+_RECENT_DOWNLOADS = (
+    select(DownloadHistory.title, DownloadHistory.media_type)
+    .order_by(DownloadHistory.download_date.desc())
+)
+
+async def get_recent_downloads(session, limit: int):
+    """Return (title, media_type) rows of the latest downloads."""
+    result = await session.execute(_RECENT_DOWNLOADS.limit(limit))
+    return result.all()
+
+# Downloads per media type, read from the maintained counters rather than
+# the history table; the handful of rows is tallied into platforms
+_DOWNLOADS_BY_TYPE = select(DownloadCounter.media_type, DownloadCounter.n)
+
+async def get_platform_counts(session) -> Tuple[int, int, int]:
+    """Return (total, youtube, instagram) download counts."""
+    result = await session.execute(_DOWNLOADS_BY_TYPE)
+    total = youtube = instagram = 0
+    for media_type, count in result:
+        total += count
+        if media_type == "youtube":
+            youtube += count
+        elif media_type.startswith("instagram"):
+            instagram += count
+    return total, youtube, instagram
+
+# Admin panel aggregates; repeated clicks and refreshes within the TTL
+# reuse the last result instead of re-running the queries
+ANALYTICS_TTL = 30
+_analytics_cache = TTLCache(maxsize=16, ttl=ANALYTICS_TTL)
+
+async def get_analytics() -> Tuple[int, int, int]:
+    """Return (total, youtube, instagram) download counts, cached."""
+    counts = _analytics_cache.get("platforms")
+    if counts is None:
+        async with db_session() as session:
+            counts = _analytics_cache["platforms"] = await get_platform_counts(session)
+    return counts
+
+async def get_admin_dashboard(recent_limit: int):
+    """Return (counts, recent downloads), running both queries concurrently.
+
+    Each query gets its own session because one AsyncSession cannot run
+    statements concurrently. The result is cached for ANALYTICS_TTL.
+    """
+    key = ("dashboard", recent_limit)
+    dashboard = _analytics_cache.get(key)
+    if dashboard is not None:
+        return dashboard
+
+    async def counts():
+        async with db_session() as session:
+            return await get_admin_counts(session)
+
+    async def recent():
+        async with db_session() as session:
+            return await get_recent_downloads(session, recent_limit)
+
+    dashboard = _analytics_cache[key] = tuple(await asyncio.gather(counts(), recent()))
+    return dashboard
+
 # --- Advanced Animation and Reaction Functions ---
-async def send_animated_message(update: Update, text: str, animation_type: str = "processing") -> Optional[int]:
-    """Send animated message with emoji sequence."""
+async def send_animated_message(message, text: str, animation_type: str = "processing") -> Optional[int]:
+    """Reply to message with text prefixed by the final emoji of the action's sequence.
+
+    A single message: cycling the emoji took up to a dozen edits and
+    several seconds per call.
+    """
     try:
-        emojis = ANIMATION_SEQUENCES.get(animation_type, ["⚙️"])
-        animated_text = f"{emojis[0]} {text}"
-        
-        msg = await update.message.reply_text(animated_text)
-        
-        # Animate for 3 cycles
-        for cycle in range(3):
-            for emoji in emojis[1:]:
-                await asyncio.sleep(0.5)
-                try:
-                    await msg.edit_text(f"{emoji} {text}")
-                except:
-                    break
-        
+        emoji = ANIMATION_SEQUENCES.get(animation_type, _DEFAULT_EMOJIS)[-1]
+        msg = await message.reply_text(f"{emoji} {text}")
         return msg.message_id
     except Exception as e:
-        logger.error(f"Error in animated message: {e}")
+        logger.error("Error in animated message: %s", e)
         return None
 
 async def add_reaction(message, emoji: str) -> bool:
@@ -195,7 +344,7 @@ async def add_reaction(message, emoji: str) -> bool:
         await message.set_reaction(emoji)
         return True
     except Exception as e:
-        logger.warning(f"Could not add reaction {emoji}: {e}")
+        logger.warning("Could not add reaction %s: %s", emoji, e)
         return False
 
 async def remove_message(message) -> bool:
@@ -204,7 +353,7 @@ async def remove_message(message) -> bool:
         await message.delete()
         return True
     except Exception as e:
-        logger.warning(f"Could not delete message: {e}")
+        logger.warning("Could not delete message: %s", e)
         return False
 
 async def edit_message(message, new_text: str) -> bool:
@@ -213,60 +362,49 @@ async def edit_message(message, new_text: str) -> bool:
         await message.edit_text(new_text)
         return True
     except Exception as e:
-        logger.warning(f"Could not edit message: {e}")
+        logger.warning("Could not edit message: %s", e)
         return False
 
 async def send_live_status_message(update: Update, text: str, status_type: str = "processing") -> int:
     """Send a live status message that can be updated."""
     try:
         msg = await update.message.reply_text(f"{REACTIONS[status_type][0]} {text}")
-        LIVE_STATUS_MESSAGES[msg.message_id] = {
-            "message": msg,
-            "status_type": status_type,
-            "emoji_index": 0,
-            "last_update": time.time()
-        }
+        LIVE_STATUS_MESSAGES[msg.message_id] = LiveStatus(msg.get_bot(), msg.chat_id, msg.message_id, status_type)
         return msg.message_id
     except Exception as e:
-        logger.error(f"Error sending live status message: {e}")
+        logger.error("Error sending live status message: %s", e)
         return None
 
 async def update_live_status(message_id: int, new_text: str, new_status_type: str = None):
-    """Update a live status message with animation."""
-    if message_id not in LIVE_STATUS_MESSAGES:
+    """Update a live status message, switching its emoji to the new status."""
+    status = LIVE_STATUS_MESSAGES.get(message_id)
+    if status is None:
         return False
     
     try:
-        status_data = LIVE_STATUS_MESSAGES[message_id]
-        message = status_data["message"]
-        
         # Update status type if provided
-        if new_status_type:
-            status_data["status_type"] = new_status_type
-            status_data["emoji_index"] = 0
-        
-        # Get current emoji sequence
-        emojis = ANIMATION_SEQUENCES.get(status_data["status_type"], ["⚙️"])
-        current_emoji = emojis[status_data["emoji_index"]]
+        if new_status_type and new_status_type != status.status_type:
+            status = status._replace(status_type=new_status_type)
+            LIVE_STATUS_MESSAGES[message_id] = status
         
-        # Update emoji index for next animation frame
-        status_data["emoji_index"] = (status_data["emoji_index"] + 1) % len(emojis)
-        status_data["last_update"] = time.time()
+        current_emoji = ANIMATION_SEQUENCES.get(status.status_type, _DEFAULT_EMOJIS)[0]
         
-        await message.edit_text(f"{current_emoji} {new_text}")
+        await status.bot.edit_message_text(
+            f"{current_emoji} {new_text}", chat_id=status.chat_id, message_id=status.message_id
+        )
         return True
     except Exception as e:
-        logger.error(f"Error updating live status: {e}")
+        logger.error("Error updating live status: %s", e)
         return False
 
 async def cleanup_live_status(message_id: int):
     """Clean up a live status message."""
-    if message_id in LIVE_STATUS_MESSAGES:
+    status = LIVE_STATUS_MESSAGES.pop(message_id, None)
+    if status is not None:
         try:
-            await remove_message(LIVE_STATUS_MESSAGES[message_id]["message"])
-        except:
-            pass
-        del LIVE_STATUS_MESSAGES[message_id]
+            await status.bot.delete_message(chat_id=status.chat_id, message_id=status.message_id)
+        except Exception as e:
+            logger.warning("Could not delete message: %s", e)
 
 async def send_temporary_message(update: Update, text: str, duration: int = 5):
     """Send a message that will be automatically deleted after duration."""
@@ -275,61 +413,58 @@ async def send_temporary_message(update: Update, text: str, duration: int = 5):
         await asyncio.sleep(duration)
         await remove_message(msg)
     except Exception as e:
-        logger.error(f"Error with temporary message: {e}")
+        logger.error("Error with temporary message: %s", e)
+
+def call_soon(callback, *args):
+    """Schedule a callback on the bot loop from any thread.
+
+    call_soon_threadsafe also wakes the loop's selector, so it is only
+    used when the caller is not already on the loop thread.
+    """
+    if threading.get_ident() == bot.LOOP_THREAD:
+        bot.LOOP.call_soon(callback, *args)
+    else:
+        bot.LOOP.call_soon_threadsafe(callback, *args)
 
 # --- Format and Utility Functions ---
+_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
 def format_file_size(size_bytes: int) -> str:
     """Format file size in human readable format."""
-    if size_bytes == 0:
+    if size_bytes <= 0:
         return "0 B"
     
-    size_names = ["B", "KB", "MB", "GB", "TB"]
-    i = 0
-    while size_bytes >= 1024 and i < len(size_names) - 1:
-        size_bytes /= 1024.0
-        i += 1
-    
-    return f"{size_bytes:.1f} {size_names[i]}"
+    # Each unit is 2**10 times the previous one, so the bit length picks it
+    i = min((size_bytes.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{size_bytes / (1 << (10 * i)):.1f} {_SIZE_UNITS[i]}"
 
 def format_duration(seconds: int) -> str:
     """Format duration in human readable format."""
-    if seconds < 60:
+    # yt-dlp reports some durations as floats, which :02d can't format
+    minutes, seconds = divmod(int(seconds), 60)
+    if not minutes:
         return f"{seconds}s"
-    elif seconds < 3600:
-        minutes = seconds // 60
-        remaining_seconds = seconds % 60
-        return f"{minutes}:{remaining_seconds:02d}"
-    else:
-        hours = seconds // 3600
-        minutes = (seconds % 3600) // 60
-        return f"{hours}:{minutes:02d}:{seconds % 60:02d}"
+    hours, minutes = divmod(minutes, 60)
+    if not hours:
+        return f"{minutes}:{seconds:02d}"
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+@lru_cache(maxsize=None)
+def _quality_buttons(lang: str) -> tuple:
+    """Rows of (label, quality) for the quality keyboard; only the labels depend on lang."""
+    return (
+        ((f"🌟 {t('quality_best', lang)}", "best"), (f"🖥️ {t('quality_1080', lang)}", "1080p")),
+        ((f"📱 {t('quality_720', lang)}", "720p"), (f"🎵 {t('quality_audio', lang)}", "audio")),
+    )
 
 def create_quality_keyboard(lang: str, user_id: int) -> InlineKeyboardMarkup:
     """Create glass-style quality selection keyboard."""
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                f"🌟 {t('quality_best', lang)}", 
-                callback_data=f"dl_best_{user_id}"
-            ),
-            InlineKeyboardButton(
-                f"🖥️ {t('quality_1080', lang)}", 
-                callback_data=f"dl_1080p_{user_id}"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                f"📱 {t('quality_720', lang)}", 
-                callback_data=f"dl_720p_{user_id}"
-            ),
-            InlineKeyboardButton(
-                f"🎵 {t('quality_audio', lang)}", 
-                callback_data=f"dl_audio_{user_id}"
-            )
-        ]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(label, callback_data=f"dl_{quality}_{user_id}") for label, quality in row]
+        for row in _quality_buttons(lang)
+    ])
 
+@lru_cache(maxsize=None)
 def create_admin_keyboard(lang: str) -> InlineKeyboardMarkup:
     """Create admin panel keyboard."""
     keyboard = [
@@ -353,45 +488,7 @@ def create_admin_keyboard(lang: str) -> InlineKeyboardMarkup:
 
 # --- Enhanced Commanders ---
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Enhanced /start command with animations and welcome."""
-    user = update.effective_user
-    await register_user(user)
-    lang = await get_user_lang(user.id)
-    
-    # Check if user is banned
-    if await is_banned(user.id):
-        await update.message.reply_text(t("banned", lang))
-        return
-    
-    # Send animated welcome
-    welcome_msg = await send_animated_message(update, t("welcome", lang), "success")
-    
-    # Add welcome reaction
-    await add_reaction(update.message, "🎬")
-    
-    # Send help tips
-    tips_text = f"""
-💡 **Quick Tips:**
-• Send any YouTube or Instagram link to start downloading
-• Use /help for commands
-• Use /lang to change language
-• Admins can use /admin for management
-"""
-    
-    await update.message.reply_text(tips_text, parse_mode=ParseMode.MARKDOWN)
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Enhanced /help with comprehensive command list."""
-    lang = await get_user_lang(update.effective_user.id)
-    user_id = update.effective_user.id
-    
-    # Check if user is banned
-    if await is_banned(user_id):
-        await update.message.reply_text(t("banned", lang))
-        return
-    
-    help_text = f"""
+_HELP_HEAD = """
 🎬 **Media Downloader Bot Help**
 
 **📱 Basic Usage:**
@@ -403,10 +500,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • /lang - Change language
 • /stats - View your statistics
 """
-    
-    # Add admin commands if user is admin
-    if await is_admin(user_id):
-        help_text += """
+
+_HELP_ADMIN = """
 **👑 Admin Commands:**
 • /admin - Open admin panel
 • /broadcast <message> - Send broadcast
@@ -414,8 +509,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • /unban <user_id> - Unban user
 • /promote <user_id> - Make admin
 """
-    
-    help_text += f"""
+
+_HELP_TAIL = """
 
 **🌐 Supported Platforms:**
 • YouTube: Videos, Playlists, Audio
@@ -429,116 +524,156 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 ---
 *Bot by Mezd | Powered by Mezdia*
+"""
+
+# /help is the same for everyone except the admin section
+HELP_TEXT = _HELP_HEAD + _HELP_TAIL
+HELP_TEXT_ADMIN = _HELP_HEAD + _HELP_ADMIN + _HELP_TAIL
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Enhanced /start command with animations and welcome."""
+    user = update.effective_user
+    state = await register_user(user)
+    lang = state.language
+    
+    # Check if user is banned
+    if state.is_banned:
+        await update.message.reply_text(t("banned", lang))
+        return
+    
+    # Send animated welcome
+    await send_animated_message(update.message, t("welcome", lang), "success")
+    
+    # Add welcome reaction
+    await add_reaction(update.message, "🎬")
+    
+    # Send help tips
+    tips_text = f"""
+💡 **Quick Tips:**
+• Send any YouTube or Instagram link to start downloading
+• Use /help for commands
+• Use /lang to change language
+• Admins can use /admin for management
 """
     
+    await update.message.reply_text(tips_text, parse_mode=ParseMode.MARKDOWN)
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Enhanced /help with comprehensive command list."""
+    state = await fetch_user_state(update.effective_user.id)
+    lang = state.language
+    
+    # Check if user is banned
+    if state.is_banned:
+        await update.message.reply_text(t("banned", lang))
+        return
+    
+    help_text = HELP_TEXT_ADMIN if state.is_admin else HELP_TEXT
+    
     await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
 
+_LANG_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🇺🇸 English", callback_data="lang_en"),
+        InlineKeyboardButton("🇮🇷 فارسی", callback_data="lang_fa")
+    ]
+])
+
 async def lang_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Enhanced /lang with beautiful language selection."""
     user_id = update.effective_user.id
     
+    state = await fetch_user_state(user_id)
+    lang = state.language
+    
     # Check if user is banned
-    if await is_banned(user_id):
-        await update.message.reply_text(t("banned", await get_user_lang(user_id)))
+    if state.is_banned:
+        await update.message.reply_text(t("banned", lang))
         return
     
-    lang = await get_user_lang(user_id)
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("🇺🇸 English", callback_data="lang_en"),
-            InlineKeyboardButton("🇮🇷 فارسی", callback_data="lang_fa")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
         t("select_lang", lang), 
-        reply_markup=reply_markup
+        reply_markup=_LANG_KEYBOARD
     )
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Enhanced /stats with user statistics."""
     user_id = update.effective_user.id
     
+    state = await fetch_user_state(user_id)
+    lang = state.language
+    
     # Check if user is banned
-    if await is_banned(user_id):
-        await update.message.reply_text(t("banned", await get_user_lang(user_id)))
+    if state.is_banned:
+        await update.message.reply_text(t("banned", lang))
         return
     
-    lang = await get_user_lang(user_id)
-    
     try:
-        async for session in get_db():
-            # Get user's download stats
+        async with db_session() as session:
+            # Count, total size and first download date in one aggregate
             result = await session.execute(
-                select(DownloadHistory)
-                .where(DownloadHistory.user_id == user_id)
-                .order_by(DownloadHistory.download_date.desc())
-                .limit(10)
+                select(
+                    func.count(),
+                    func.coalesce(func.sum(DownloadHistory.file_size), 0),
+                    func.min(DownloadHistory.download_date),
+                ).where(DownloadHistory.user_id == user_id)
             )
-            user_downloads = result.scalars().all()
+            total_downloads, total_size, first_download = result.one()
             
-            # Get total downloads count
-            total_downloads = await session.scalar(
-                select(DownloadHistory).where(DownloadHistory.user_id == user_id).count()
+            # Only the columns shown in the recent list
+            result = await session.execute(
+                select(DownloadHistory.title, DownloadHistory.media_type)
+                .where(DownloadHistory.user_id == user_id)
+                .order_by(DownloadHistory.download_date.desc())
+                .limit(3)
             )
-            
-            # Calculate total file size
-            total_size = sum(d.file_size or 0 for d in user_downloads)
+            recent = result.all()
         
         stats_text = f"""
 📊 **Your Statistics**
 
 📥 **Downloads:** {total_downloads}
 💾 **Total Size:** {format_file_size(total_size)}
-📅 **Member since:** {user_downloads[-1].download_date.strftime('%Y-%m-%d') if user_downloads else 'N/A'}
+📅 **Member since:** {first_download.strftime('%Y-%m-%d') if first_download else 'N/A'}
 """
         
-        if user_downloads:
-            recent = user_downloads[:3]
-            stats_text += "\n🎬 **Recent Downloads:**\n"
-            for download in recent:
-                title = download.title[:30] + "..." if len(download.title or "") > 30 else download.title or "Unknown"
-                stats_text += f"• {title} ({download.media_type})\n"
+        if recent:
+            stats_text = "".join((stats_text, "\n🎬 **Recent Downloads:**\n", format_recent(recent, 30)))
         
         await update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
         
     except Exception as e:
-        logger.error(f"Error getting user stats: {e}")
+        logger.error("Error getting user stats: %s", e)
         await update.message.reply_text("❌ Error getting statistics")
 
 # --- Admin Command Handlers ---
 
-async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Enhanced comprehensive admin panel within Telegram with live stats and actions."""
-    user_id = update.effective_user.id
-    
-    if not await is_admin(user_id):
-        lang = await get_user_lang(user_id)
-        await update.message.reply_text(t("not_admin", lang))
-        return
-    
-    lang = await get_user_lang(user_id)
+def format_recent(recent, width: int) -> str:
+    """Render (title, media_type) rows as bullet lines, titles cut to width."""
+    return "".join(
+        f"• {title[:width] + '...' if len(title or '') > width else title or 'Unknown'} ({media_type})\n"
+        for title, media_type in recent
+    )
+
+_ADMIN_PANEL_TAIL = """
+⚡ **Quick Actions:**
+📊 View Stats • 👥 Manage Users
+📢 Broadcast • ⚙️ Variables
+🔧 Settings • 📜 Live Logs
+
+💡 **Admin Tips:**
+• Use /setvar key=value to create variables
+• Use /getvar key to retrieve variables
+• Use /broadcast message to send announcements
+"""
+
+@lru_cache(maxsize=32)
+def _render_admin_panel(counts: tuple, recent: tuple) -> str:
+    """Render the /admin dashboard text; cached since the inputs change slowly."""
+    users_count, admins_count, banned_count, downloads_count = counts
     
-    # Get comprehensive bot stats
-    try:
-        async for session in get_db():
-            users_count = await session.scalar(select(User).count())
-            downloads_count = await session.scalar(select(DownloadHistory).count())
-            admins_count = await session.scalar(select(User).where(User.is_admin == True).count())
-            banned_count = await session.scalar(select(User).where(User.is_banned == True).count())
-            
-            # Get recent activity
-            recent_downloads = await session.execute(
-                select(DownloadHistory)
-                .order_by(DownloadHistory.download_date.desc())
-                .limit(3)
-            )
-            recent = recent_downloads.scalars().all()
-        
-        # Enhanced admin panel with live stats
-        admin_text = f"""
+    # Enhanced admin panel with live stats
+    admin_text = f"""
 👑 **Admin Panel - Live Dashboard**
 
 📊 **System Statistics:**
@@ -549,50 +684,52 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 🎬 **Recent Activity:**
 """
-        
-        for idx, download in enumerate(recent):
-            title = download.title[:25] + "..." if len(download.title or "") > 25 else download.title or "Unknown"
-            admin_text += f"• {title} ({download.media_type})\n"
-        
-        admin_text += """
-⚡ **Quick Actions:**
-📊 View Stats • 👥 Manage Users
-📢 Broadcast • ⚙️ Variables
-🔧 Settings • 📜 Live Logs
+    
+    return "".join((admin_text, format_recent(recent, 25), _ADMIN_PANEL_TAIL))
+
+# Actions under the /admin dashboard
+ADMIN_PANEL_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📊 Live Stats", callback_data="admin_stats"),
+        InlineKeyboardButton("👥 User Management", callback_data="admin_users")
+    ],
+    [
+        InlineKeyboardButton("📢 Broadcast", callback_data="admin_broadcast"),
+        InlineKeyboardButton("⚙️ Variables", callback_data="admin_vars")
+    ],
+    [
+        InlineKeyboardButton("🔧 System Settings", callback_data="admin_settings"),
+        InlineKeyboardButton("📜 Live Logs", callback_data="admin_logs")
+    ],
+    [
+        InlineKeyboardButton("📈 Analytics", callback_data="admin_analytics"),
+        InlineKeyboardButton("🔄 Refresh", callback_data="admin_refresh")
+    ],
+    [
+        InlineKeyboardButton("❌ Close Panel", callback_data="admin_close")
+    ]
+])
 
-💡 **Admin Tips:**
-• Use /setvar key=value to create variables
-• Use /getvar key to retrieve variables
-• Use /broadcast message to send announcements
-"""
-        
-        # Enhanced admin keyboard with more options
-        reply_markup = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("📊 Live Stats", callback_data="admin_stats"),
-                InlineKeyboardButton("👥 User Management", callback_data="admin_users")
-            ],
-            [
-                InlineKeyboardButton("📢 Broadcast", callback_data="admin_broadcast"),
-                InlineKeyboardButton("⚙️ Variables", callback_data="admin_vars")
-            ],
-            [
-                InlineKeyboardButton("🔧 System Settings", callback_data="admin_settings"),
-                InlineKeyboardButton("📜 Live Logs", callback_data="admin_logs")
-            ],
-            [
-                InlineKeyboardButton("📈 Analytics", callback_data="admin_analytics"),
-                InlineKeyboardButton("🔄 Refresh", callback_data="admin_refresh")
-            ],
-            [
-                InlineKeyboardButton("❌ Close Panel", callback_data="admin_close")
-            ]
-        ])
+async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Enhanced comprehensive admin panel within Telegram with live stats and actions."""
+    user_id = update.effective_user.id
+    
+    state = await fetch_user_state(user_id)
+    lang = state.language
+    
+    if not state.is_admin:
+        await update.message.reply_text(t("not_admin", lang))
+        return
+    
+    # Get comprehensive bot stats
+    try:
+        counts, recent = await get_admin_dashboard(3)
+        admin_text = _render_admin_panel(counts, tuple(map(tuple, recent)))
         
         # Send admin panel with enhanced features
         admin_msg = await update.message.reply_text(
             admin_text,
-            reply_markup=reply_markup,
+            reply_markup=ADMIN_PANEL_KEYBOARD,
             parse_mode=ParseMode.MARKDOWN
         )
         
@@ -603,16 +740,17 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['admin_msg_id'] = admin_msg.message_id
         
     except Exception as e:
-        logger.error(f"Error in admin panel: {e}")
+        logger.error("Error in admin panel: %s", e)
         await update.message.reply_text("❌ Error loading admin panel")
         await add_reaction(update.message, "💥")
 
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Enhanced broadcast with targeting and preview."""
-    if not await is_admin(update.effective_user.id):
+    state = await fetch_user_state(update.effective_user.id)
+    if not state.is_admin:
         return
     
-    lang = await get_user_lang(update.effective_user.id)
+    lang = state.language
     message = " ".join(context.args)
     
     if not message:
@@ -646,12 +784,71 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
+    # Kept until the admin confirms or cancels the preview
+    context.user_data['broadcast_message'] = message
+    
     await update.message.reply_text(
         preview_text, 
         reply_markup=reply_markup, 
         parse_mode=ParseMode.MARKDOWN
     )
 
+# Broadcast recipients are read in keyset-paged batches, each in its own
+# short session, so no pooled connection or read snapshot is held while
+# the batch is being sent
+BROADCAST_BATCH_SIZE = 25
+_SEL_BROADCAST_IDS = (
+    select(User.id, User.telegram_id)
+    .where(User.is_banned == False, User.id > bindparam("after"))
+    .order_by(User.id)
+    .limit(BROADCAST_BATCH_SIZE)
+)
+
+async def send_broadcast(tg_bot, text: str) -> Tuple[int, int]:
+    """Send text to every non-banned user; returns (sent, failed).
+
+    Each batch is sent concurrently; the application's rate limiter paces
+    the requests. The text is the admin's own, so it is sent without a
+    parse mode.
+    """
+    sent = failed = 0
+    after = 0
+    while True:
+        async with db_session() as session:
+            result = await session.execute(_SEL_BROADCAST_IDS, {"after": after})
+            rows = result.all()
+        if not rows:
+            break
+        after = rows[-1].id
+
+        results = await asyncio.gather(
+            *(tg_bot.send_message(chat_id=chat_id, text=text) for _, chat_id in rows),
+            return_exceptions=True
+        )
+        errors = sum(isinstance(r, Exception) for r in results)
+        sent += len(results) - errors
+        failed += errors
+        if len(rows) < BROADCAST_BATCH_SIZE:
+            break
+    return sent, failed
+
+_broadcast_tasks = set() # Strong references to running broadcasts
+
+async def _run_broadcast(query, tg_bot, text: str):
+    """Send a confirmed broadcast and report the result on the admin's message."""
+    try:
+        sent, failed = await send_broadcast(tg_bot, text)
+        await query.edit_message_text(
+            f"📢 **Broadcast Sent Successfully!**\n\n✅ Delivered: {sent}\n❌ Failed: {failed}",
+            parse_mode=ParseMode.MARKDOWN
+        )
+    except Exception as e:
+        logger.error("Broadcast failed: %s", e)
+        try:
+            await query.edit_message_text("❌ Error processing broadcast")
+        except Exception:
+            pass
+
 # --- Additional Admin Commands ---
 
 async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -674,20 +871,10 @@ async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ You cannot ban yourself!")
             return
         
-        async for session in get_db():
-            result = await session.execute(select(User).where(User.telegram_id == target_user_id))
-            user = result.scalar_one_or_none()
-            
-            if not user:
-                await update.message.reply_text("❌ User not found in database.")
-                return
-            
-            if user.is_banned:
-                await update.message.reply_text("⚠️ User is already banned.")
-                return
-            
-            user.is_banned = True
-            await session.commit()
+        user, exists = await update_user_flag(target_user_id, "is_banned", True)
+        if not user:
+            await update.message.reply_text("⚠️ User is already banned." if exists else "❌ User not found in database.")
+            return
         
         await update.message.reply_text(
             f"✅ **User Banned Successfully**\n\n"
@@ -709,7 +896,7 @@ async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID. Please provide a numeric user ID.")
     except Exception as e:
-        logger.error(f"Ban command error: {e}")
+        logger.error("Ban command error: %s", e)
         await update.message.reply_text("❌ Error banning user.")
 
 async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -728,20 +915,10 @@ async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         target_user_id = int(context.args[0])
         
-        async for session in get_db():
-            result = await session.execute(select(User).where(User.telegram_id == target_user_id))
-            user = result.scalar_one_or_none()
-            
-            if not user:
-                await update.message.reply_text("❌ User not found in database.")
-                return
-            
-            if not user.is_banned:
-                await update.message.reply_text("ℹ️ User is not banned.")
-                return
-            
-            user.is_banned = False
-            await session.commit()
+        user, exists = await update_user_flag(target_user_id, "is_banned", False)
+        if not user:
+            await update.message.reply_text("ℹ️ User is not banned." if exists else "❌ User not found in database.")
+            return
         
         await update.message.reply_text(
             f"✅ **User Unbanned Successfully**\n\n"
@@ -763,7 +940,7 @@ async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID. Please provide a numeric user ID.")
     except Exception as e:
-        logger.error(f"Unban command error: {e}")
+        logger.error("Unban command error: %s", e)
         await update.message.reply_text("❌ Error unbanning user.")
 
 async def promote_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -786,21 +963,18 @@ async def promote_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("ℹ️ You are already an admin!")
             return
         
-        async for session in get_db():
-            result = await session.execute(select(User).where(User.telegram_id == target_user_id))
-            user = result.scalar_one_or_none()
-            
-            if not user:
-                # Create user if not exists
-                user = User(telegram_id=target_user_id, username="Unknown", full_name="Unknown User")
-                session.add(user)
-            
-            if user.is_admin:
+        user, exists = await update_user_flag(target_user_id, "is_admin", True)
+        if not user:
+            if exists:
                 await update.message.reply_text("⚠️ User is already an admin.")
                 return
             
-            user.is_admin = True
-            await session.commit()
+            # Create user if not exists
+            user = User(telegram_id=target_user_id, username="Unknown", full_name="Unknown User", is_admin=True)
+            async with db_session() as session:
+                session.add(user)
+                await session.commit()
+            invalidate_user_state(target_user_id)
         
         await update.message.reply_text(
             f"✅ **User Promoted to Admin**\n\n"
@@ -822,7 +996,7 @@ async def promote_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID. Please provide a numeric user ID.")
     except Exception as e:
-        logger.error(f"Promote command error: {e}")
+        logger.error("Promote command error: %s", e)
         await update.message.reply_text("❌ Error promoting user.")
 
 async def demote_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -845,20 +1019,10 @@ async def demote_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ You cannot demote yourself!")
             return
         
-        async for session in get_db():
-            result = await session.execute(select(User).where(User.telegram_id == target_user_id))
-            user = result.scalar_one_or_none()
-            
-            if not user:
-                await update.message.reply_text("❌ User not found in database.")
-                return
-            
-            if not user.is_admin:
-                await update.message.reply_text("ℹ️ User is not an admin.")
-                return
-            
-            user.is_admin = False
-            await session.commit()
+        user, exists = await update_user_flag(target_user_id, "is_admin", False)
+        if not user:
+            await update.message.reply_text("ℹ️ User is not an admin." if exists else "❌ User not found in database.")
+            return
         
         await update.message.reply_text(
             f"✅ **Admin Demoted Successfully**\n\n"
@@ -880,7 +1044,7 @@ async def demote_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID. Please provide a numeric user ID.")
     except Exception as e:
-        logger.error(f"Demote command error: {e}")
+        logger.error("Demote command error: %s", e)
         await update.message.reply_text("❌ Error demoting user.")
 
 # --- Enhanced Variable Management Commands ---
@@ -942,7 +1106,7 @@ async def setvar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await add_reaction(update.message, "❌")
             
     except Exception as e:
-        logger.error(f"Set variable error: {e}")
+        logger.error("Set variable error: %s", e)
         await update.message.reply_text("❌ Error processing variable")
         await add_reaction(update.message, "💥")
 
@@ -961,28 +1125,28 @@ async def getvar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         key = context.args[0].strip()
-        value = await get_variable(key)
         
-        if value:
-            async for session in get_db():
-                result = await session.execute(select(Variable).where(Variable.key == key))
-                var = result.scalar_one_or_none()
-                
-                response = f"🔑 **Variable Found**\n\n"
-                response += f"🔑 Key: `{key}`\n"
-                response += f"📝 Value:\n```\n{value}\n```\n"
-                
-                if var and var.description:
-                    response += f"📋 Description: `{var.description}`\n"
-                
-                await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
-                await add_reaction(update.message, "🎯")
+        # Value and description come from the same row
+        async with db_session() as session:
+            result = await session.execute(_SEL_VAR_BY_KEY, {"key": key})
+            var = result.scalar_one_or_none()
+        
+        if var and var.value:
+            response = f"🔑 **Variable Found**\n\n"
+            response += f"🔑 Key: `{key}`\n"
+            response += f"📝 Value:\n```\n{var.value}\n```\n"
+            
+            if var.description:
+                response += f"📋 Description: `{var.description}`\n"
+            
+            await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
+            await add_reaction(update.message, "🎯")
         else:
             await update.message.reply_text(f"❌ Variable `{key}` not found")
             await add_reaction(update.message, "❌")
             
     except Exception as e:
-        logger.error(f"Get variable error: {e}")
+        logger.error("Get variable error: %s", e)
         await update.message.reply_text("❌ Error retrieving variable")
         await add_reaction(update.message, "💥")
 
@@ -1011,86 +1175,84 @@ async def delvar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await add_reaction(update.message, "❌")
             
     except Exception as e:
-        logger.error(f"Delete variable error: {e}")
+        logger.error("Delete variable error: %s", e)
         await update.message.reply_text("❌ Error deleting variable")
         await add_reaction(update.message, "💥")
 
 # --- Enhanced Message Handler (The Core) ---
 
+# Supported links, one named alternative per URL type (tried in this order);
+# the type is the name of the alternative that matched
+_URL_RE = re.compile(
+    r'(?P<youtube>https?://(?:www\.)?(?:youtube\.com|youtu\.be)/(?:watch\?v=|embed/|v/|.*[?&]v=)?[\w-]{11})'
+    r'|(?P<instagram_post>https?://(?:www\.)?instagram\.com/p/[\w-]+)'
+    r'|(?P<instagram_reel>https?://(?:www\.)?instagram\.com/reel/[\w-]+)'
+    r'|(?P<instagram_story>https?://(?:www\.)?instagram\.com/stories/[^/]+)'
+    r'|(?P<instagram_profile>https?://(?:www\.)?instagram\.com/[^/]+/?$)'
+)
+
+URL_TYPE_REACTIONS = MappingProxyType({
+    'youtube': '🎬',
+    'instagram_post': '📷',
+    'instagram_reel': '🎵',
+    'instagram_story': '✨',
+    'instagram_profile': '👤'
+})
+
+MAX_LINK_LENGTH = 2048 # Longer texts are not treated as links
+
+# Closing line of the link info message
+_INFO_SELECT_QUALITY = "\n📱 **Select Quality:**"
+_INFO_IMAGE = "\n🖼️ **Image detected - Ready to download**"
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Enhanced initial link handling with live status tracking and quality selection."""
     text = update.message.text
-    user = update.effective_user
-    user_id = user.id
-    lang = await get_user_lang(user_id)
     
-    # Check if user is banned
-    if await is_banned(user_id):
-        await update.message.reply_text(t("banned", lang))
+    # Detect URL type before any database work; in groups most messages
+    # are ordinary chat, which the bot ignores without a lookup
+    match = _URL_RE.match(text) if len(text) <= MAX_LINK_LENGTH else None
+    if not match and update.effective_chat.type != ChatType.PRIVATE:
         return
     
-    # Enhanced URL pattern matching
-    url_patterns = {
-        'youtube': r'https?://(?:www\.)?(?:youtube\.com|youtu\.be)/(?:watch\?v=|embed/|v/|.*[?&]v=)?([\w-]{11})',
-        'instagram_post': r'https?://(?:www\.)?instagram\.com/p/([\w-]+)',
-        'instagram_reel': r'https?://(?:www\.)?instagram\.com/reel/([\w-]+)',
-        'instagram_story': r'https?://(?:www\.)?instagram\.com/stories/([^/]+)',
-        'instagram_profile': r'https?://(?:www\.)?instagram\.com/([^/]+)/?$'
-    }
+    user_id = update.effective_user.id
+    state = await fetch_user_state(user_id)
+    lang = state.language
     
-    # Detect URL type
-    url_type = None
-    for platform, pattern in url_patterns.items():
-        if re.match(pattern, text):
-            url_type = platform
-            break
+    # Check if user is banned
+    if state.is_banned:
+        await update.message.reply_text(t("banned", lang))
+        return
     
-    if not url_type:
+    if not match:
         await update.message.reply_text(t("invalid_url", lang))
         return
+    url_type = match.lastgroup
     
-    # Add reaction based on URL type
-    reactions = {
-        'youtube': '🎬',
-        'instagram_post': '📷',
-        'instagram_reel': '🎵',
-        'instagram_story': '✨',
-        'instagram_profile': '👤'
-    }
-    
-    await add_reaction(update.message, reactions.get(url_type, '👀'))
-    
-    # Send live status message
-    status_msg_id = await send_live_status_message(update, t("searching", lang), "searching")
+    # React to the link and send the live status message together
+    _, status_msg_id = await asyncio.gather(
+        add_reaction(update.message, URL_TYPE_REACTIONS.get(url_type, '👀')),
+        send_live_status_message(update, t("searching", lang), "searching"),
+    )
     
     try:
         # Enhanced info extraction
         info = await main.internal_get_formats(text)
         
-        # Store URL and info in user context
-        context.user_data['last_url'] = text
-        context.user_data['video_info'] = info
-        context.user_data['url_type'] = url_type
-        context.user_data['status_msg_id'] = status_msg_id
+        # Keep only what the quality callback needs; the info dict (with
+        # its full format list) is not kept around in user_data
+        context.user_data.update(last_url=text, url_type=url_type, status_msg_id=status_msg_id)
         
         # Create enhanced info display
         title = info.get("title", "Media Content")
         duration = info.get("duration")
-        thumbnail = info.get("thumbnail")
         
         # Format info message
-        info_text = f"""
-🎬 **{title}**
-
-"""
-        
-        if duration:
-            info_text += f"⏱️ Duration: {format_duration(duration)}\n"
-        
-        if info.get("is_video", True):
-            info_text += f"\n📱 **Select Quality:**"
-        else:
-            info_text += f"\n🖼️ **Image detected - Ready to download**"
+        info_text = "".join((
+            f"\n🎬 **{title}**\n\n",
+            f"⏱️ Duration: {format_duration(duration)}\n" if duration else "",
+            _INFO_SELECT_QUALITY if info.get("is_video", True) else _INFO_IMAGE,
+        ))
         
         # Create quality keyboard with glass-style buttons
         reply_markup = create_quality_keyboard(lang, user_id)
@@ -1113,19 +1275,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await remove_message(update.message)
         
         # Log the activity
-        async for session in get_db():
-            activity = DownloadHistory(
-                user_id=user_id,
-                link=text,
-                media_type=url_type,
-                title=title,
-                status="requested"
-            )
-            session.add(activity)
-            await session.commit()
+        log_download(
+            user_id=user_id,
+            link=text,
+            media_type=url_type,
+            title=title,
+            status="requested"
+        )
         
     except Exception as e:
-        logger.error(f"Search error: {e}")
+        logger.error("Search error: %s", e)
         
         # Send error message
         error_text = f"""
@@ -1156,78 +1315,111 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- Enhanced Callback Handler ---
 
+# Callback data formats: "lang_<code>" and "dl_<quality>_<user id>"
+_CB_LANG = re.compile(r"lang_(en|fa)$")
+_CB_DL = re.compile(r"dl_(best|1080p|720p|audio)_(\d+)$")
+
+# Quality button key -> quality passed to the downloader
+QUALITY_MAP = {
+    "best": "best",
+    "1080p": "1080p",
+    "720p": "720p",
+    "audio": "audio_only"
+}
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Enhanced button callback handler with comprehensive admin panel."""
     query = update.callback_query
-    await query.answer()
-    
     data = query.data
     user_id = query.from_user.id
-    lang = await get_user_lang(user_id)
+    prefix, _, rest = data.partition("_")
+    route = CALLBACK_ROUTES.get(prefix)
+    if route is None:
+        await query.answer()
+        return
+    handler, owned = route
     
-    # Security check: only allow the user who sent the command
-    if "_" in data and str(user_id) not in data:
-        if not data.startswith("admin_") and not data.startswith("lang_"):
-            await query.answer("This menu is not for you.", show_alert=True)
-            return
+    # Security check: menus sent to one user end with that user's id
+    if owned and rest.rpartition("_")[2] != str(user_id):
+        await query.answer("This menu is not for you.", show_alert=True)
+        return
+    
+    _, lang = await asyncio.gather(query.answer(), get_user_lang(user_id))
+    await handler(query, context, data, user_id, lang)
+
+async def handle_lang_callback(query, context, data, user_id, lang):
+    """Switch the user's interface language."""
+    m = _CB_LANG.match(data)
+    if not m:
+        return
+    new_lang = m.group(1)
     
-    # Language selection
-    if data.startswith("lang_"):
-        new_lang = data.split("_")[1]
+    try:
+        async with db_session() as session:
+            result = await session.execute(_SEL_USER_BY_TID, {"tid": user_id})
+            user = result.scalar_one_or_none()
+            if user:
+                user.language = new_lang
+                await session.commit()
+                invalidate_user_state(user_id)
         
-        try:
-            async for session in get_db():
-                result = await session.execute(select(User).where(User.telegram_id == user_id))
-                user = result.scalar_one_or_none()
-                if user:
-                    user.language = new_lang
-                    await session.commit()
-            
-            # Send success message
-            success_text = f"""
+        # Send success message
+        success_text = f"""
 ✅ **Language Updated**
 
 🌐 New language: {'English' if new_lang == 'en' else 'فارسی'}
 
 🔄 The bot interface will now use your selected language.
 """
-            
-            await query.edit_message_text(success_text, parse_mode=ParseMode.MARKDOWN)
-            
-            # Add success reaction
-            await add_reaction(query.message, "🌍")
-            
-        except Exception as e:
-            logger.error(f"Error updating language: {e}")
-            await query.edit_message_text("❌ Error updating language")
-    
-    # Download quality selection
-    elif data.startswith("dl_"):
-        await handle_download_callback(query, context, data, user_id, lang)
-    
-    # Admin panel callbacks
-    elif data.startswith("admin_"):
-        await handle_admin_callback(query, context, data, user_id, lang)
-    
-    # Broadcast callbacks
-    elif data.startswith("broadcast_"):
-        await handle_broadcast_callback(query, context, data, user_id, lang)
+        
+        await query.edit_message_text(success_text, parse_mode=ParseMode.MARKDOWN)
+        
+        # Add success reaction
+        await add_reaction(query.message, "🌍")
+        
+    except Exception as e:
+        logger.error("Error updating language: %s", e)
+        await query.edit_message_text("❌ Error updating language")
 
-async def handle_download_callback(query, context, data, user_id, lang):
+async def handle_dl_callback(query, context, data, user_id, lang):
+    """Start a download in the quality the user picked."""
+    if m := _CB_DL.match(data):
+        await handle_download_callback(query, context, m.group(1), user_id, lang)
+
+# chat_id -> queue of pending download jobs. Downloads run outside the update
+# handler so a long download doesn't hold up updates from other chats; each
+# chat's worker runs its jobs in order and exits once the queue is empty.
+chat_workers: Dict[int, asyncio.Queue] = {}
+_worker_tasks = set() # Strong references to the running workers
+
+async def _chat_worker(chat_id: int, queue: asyncio.Queue):
+    try:
+        while True:
+            try:
+                job = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            try:
+                await job
+            except Exception as e:
+                logger.error("Download job for chat %s failed: %s", chat_id, e)
+    finally:
+        del chat_workers[chat_id]
+
+def enqueue_chat_job(chat_id: int, job):
+    """Queue a coroutine to run after the chat's earlier jobs."""
+    queue = chat_workers.get(chat_id)
+    if queue is None:
+        queue = chat_workers[chat_id] = asyncio.Queue()
+        task = asyncio.get_running_loop().create_task(_chat_worker(chat_id, queue))
+        _worker_tasks.add(task)
+        task.add_done_callback(_worker_tasks.discard)
+    queue.put_nowait(job)
+
+async def handle_download_callback(query, context, quality_key, user_id, lang):
     """Handle download quality selection with enhanced processing."""
     try:
-        # Extract quality from data "dl_QUALITY_USERID"
-        parts = data.split("_")
-        quality_key = parts[1]
-        
-        quality_map = {
-            "best": "best",
-            "1080p": "1080p",
-            "720p": "720p",
-            "audio": "audio_only"
-        }
-        
-        quality = quality_map.get(quality_key, "best")
+        quality = QUALITY_MAP[quality_key]
         url = context.user_data.get('last_url')
         url_type = context.user_data.get('url_type')
         
@@ -1235,35 +1427,50 @@ async def handle_download_callback(query, context, data, user_id, lang):
             await query.edit_message_text("⏰ Session expired. Please send the link again.")
             return
         
-        # Add processing reaction
-        await add_reaction(query.message, "⚙️")
-        
-        # Send processing animation
-        processing_msg = await send_animated_message(
-            type('MockUpdate', (), {'message': query.message, 'effective_user': query.from_user})(),
-            f"Preparing {quality} download...",
-            "processing"
-        )
-        
-        # Start download process
-        await query.edit_message_text(
-            f"⬇️ **Starting Download**\n\n"
-            f"🔗 URL: `{url[:30]}{'...' if len(url) > 30 else ''}`\n"
-            f"🎯 Quality: {quality}\n"
-            f"📱 Platform: {url_type.title()}\n\n"
-            f"⏳ Please wait...",
-            parse_mode=ParseMode.MARKDOWN
+        # React, send the processing message and show the download start at once
+        await asyncio.gather(
+            add_reaction(query.message, "⚙️"),
+            send_animated_message(
+                query.message,
+                f"Preparing {quality} download...",
+                "processing"
+            ),
+            query.edit_message_text(
+                f"⬇️ **Starting Download**\n\n"
+                f"🔗 URL: `{url[:30]}{'...' if len(url) > 30 else ''}`\n"
+                f"🎯 Quality: {quality}\n"
+                f"📱 Platform: {url_type.title()}\n\n"
+                f"⏳ Please wait...",
+                parse_mode=ParseMode.MARKDOWN
+            ),
         )
         
-        # Trigger download
-        await process_download_with_progress(
+        # Queue the download behind any earlier ones from this chat
+        enqueue_chat_job(query.message.chat_id, process_download_with_progress(
             query, context, url, quality, url_type, user_id, lang
-        )
+        ))
         
     except Exception as e:
-        logger.error(f"Download callback error: {e}")
+        logger.error("Download callback error: %s", e)
         await query.edit_message_text("❌ Error starting download")
 
+PROGRESS_INTERVAL = 2.0 # Seconds between download progress edits
+
+def remove_files(paths):
+    """Delete downloaded files, skipping None entries; runs in an executor."""
+    for path in paths:
+        if path:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning("Could not delete %s: %s", path, e)
+
+_PROGRESS_FINISHED = """
+✅ **Download Complete!**
+
+🚀 Preparing for upload...
+"""
+
 async def process_download_with_progress(query, context, url, quality, url_type, user_id, lang):
     """Process download with live progress tracking and enhanced status updates."""
     try:
@@ -1276,22 +1483,39 @@ async def process_download_with_progress(query, context, url, quality, url_type,
         # Get status message ID from context if available
         status_msg_id = context.user_data.get('status_msg_id')
         
-        # Progress tracking variables
-        last_update = time.time()
+        # yt-dlp's hook runs on a worker thread and offers (progress text,
+        # live status text, status type) frames to a one-slot queue; a single
+        # reporter task edits the messages, so a newer frame replaces one that
+        # hasn't been shown yet and edits never overlap
+        last_update = time.monotonic()
         progress_msg = query.message
+        progress_q = asyncio.Queue(maxsize=1)
+        
+        def offer_progress(frame):
+            if progress_q.full():
+                progress_q.get_nowait()
+            progress_q.put_nowait(frame)
+        
+        async def report_progress():
+            while True:
+                progress_text, status_text, status_type = await progress_q.get()
+                await update_progress_message(progress_msg, progress_text)
+                if status_msg_id:
+                    await update_live_status(status_msg_id, status_text, status_type)
         
         def progress_hook(d):
-            nonlocal last_update, progress_msg
-            current_time = time.time()
-            
-            # Update progress every 2 seconds
-            if current_time - last_update >= 2:
-                if d['status'] == 'downloading':
-                    percent = d.get('_percent_str', '').strip()
-                    speed = d.get('_speed_str', '').strip()
-                    eta = d.get('_eta_str', '').strip()
-                    
-                    progress_text = f"""
+            nonlocal last_update
+            if d['status'] == 'downloading':
+                # At most one frame per PROGRESS_INTERVAL
+                current_time = time.monotonic()
+                if current_time - last_update < PROGRESS_INTERVAL:
+                    return
+                last_update = current_time
+                percent = d.get('_percent_str', '').strip()
+                speed = d.get('_speed_str', '').strip()
+                eta = d.get('_eta_str', '').strip()
+                
+                progress_text = f"""
 ⬇️ **Downloading...**
 
 📊 Progress: {percent}
@@ -1299,35 +1523,22 @@ async def process_download_with_progress(query, context, url, quality, url_type,
 ⏱️ ETA: {eta}
 🎯 Quality: {quality}
 """
-                    
-                    # Update progress message
-                    asyncio.create_task(update_progress_message(progress_msg, progress_text))
-                    
-                    # Update live status if exists
-                    if status_msg_id:
-                        asyncio.create_task(update_live_status(status_msg_id, f"Downloading: {percent}", "live_download"))
-                    
-                    last_update = current_time
-                
-                elif d['status'] == 'finished':
-                    progress_text = """
-✅ **Download Complete!**
-
-🚀 Preparing for upload...
-"""
-                    asyncio.create_task(update_progress_message(progress_msg, progress_text))
-                    
-                    # Update live status
-                    if status_msg_id:
-                        asyncio.create_task(update_live_status(status_msg_id, "Uploading to Telegram...", "live_upload"))
+                call_soon(offer_progress, (progress_text, f"Downloading: {percent}", "live_download"))
+            
+            elif d['status'] == 'finished':
+                call_soon(offer_progress, (_PROGRESS_FINISHED, "Uploading to Telegram...", "live_upload"))
         
         # Start download
-        file_info = await main.internal_download_video(
-            url,
-            quality=quality,
-            download_type=download_type,
-            progress_hooks=[progress_hook]
-        )
+        reporter = asyncio.create_task(report_progress())
+        try:
+            file_info = await main.internal_download_video(
+                url,
+                quality=quality,
+                download_type=download_type,
+                progress_hooks=[progress_hook]
+            )
+        finally:
+            reporter.cancel()
         
         # Upload phase
         upload_text = """
@@ -1335,42 +1546,54 @@ async def process_download_with_progress(query, context, url, quality, url_type,
 
 🎬 Processing media file...
 """
-        await update_progress_message(progress_msg, upload_text)
+        if status_msg_id:
+            await asyncio.gather(
+                update_progress_message(progress_msg, upload_text),
+                update_live_status(status_msg_id, "Uploading to Telegram...", "live_upload"),
+            )
+        else:
+            await update_progress_message(progress_msg, upload_text)
         
-        # Send file
+        # Send file (read off the event loop, the size comes from the downloader)
         file_path = file_info["file_path"]
-        file_size = os.path.getsize(file_path)
+        file_size = file_info["file_size"]
+        thumbnail_path = file_info.get("thumbnail_path")
+        try:
+            async with aiofiles.open(file_path, 'rb') as f:
+                media = await f.read()
+        
+            # Get thumbnail if the downloader wrote one
+            thumbnail = None
+            if thumbnail_path and download_type != "audio":
+                async with aiofiles.open(thumbnail_path, 'rb') as tf:
+                    thumbnail = await tf.read()
         
-        with open(file_path, 'rb') as f:
             if download_type == "audio":
                 await context.bot.send_audio(
                     chat_id=query.message.chat_id,
-                    audio=f,
+                    audio=media,
+                    filename=file_info['filename'],
                     title=file_info['title'][:100],  # Telegram audio title limit
                     caption=f"🎵 {file_info['title']}\n\n📊 Size: {format_file_size(file_size)}\n🤖 Downloaded via Media Bot",
                     parse_mode=ParseMode.MARKDOWN
                 )
             else:
-                # Get thumbnail if available
-                thumbnail_path = file_path.replace(".mp4", ".jpg")
-                thumbnail_file = None
-                if os.path.exists(thumbnail_path):
-                    thumbnail_file = open(thumbnail_path, 'rb')
-                
                 await context.bot.send_video(
                     chat_id=query.message.chat_id,
-                    video=f,
+                    video=media,
+                    filename=file_info['filename'],
                     caption=f"🎬 {file_info['title']}\n\n📊 Size: {format_file_size(file_size)}\n🎯 Quality: {quality}\n🤖 Downloaded via Media Bot",
                     parse_mode=ParseMode.MARKDOWN,
                     supports_streaming=True,
                     width=file_info.get("width"),
                     height=file_info.get("height"),
                     duration=file_info.get("duration"),
-                    thumbnail=thumbnail_file
+                    thumbnail=thumbnail
                 )
-                
-                if thumbnail_file:
-                    thumbnail_file.close()
+        finally:
+            # Delete after the upload, whether it or the reads failed, instead
+            # of leaving the files for the periodic cleanup
+            await asyncio.get_running_loop().run_in_executor(None, remove_files, (file_path, thumbnail_path))
         
         # Success message
         success_text = f"""
@@ -1391,8 +1614,8 @@ async def process_download_with_progress(query, context, url, quality, url_type,
             await asyncio.sleep(3)
             await cleanup_live_status(status_msg_id)
         
-        # Add success reactions
-        await add_reaction(progress_msg, "🎉")
+        # Add success reaction (a bot can set one reaction per message, a
+        # second call would only replace the first)
         await add_reaction(progress_msg, "✅")
         
         # Clean up main message if it exists
@@ -1404,25 +1627,15 @@ async def process_download_with_progress(query, context, url, quality, url_type,
             except:
                 pass
         
-        # Log successful download
-        async for session in get_db():
-            history = DownloadHistory(
-                user_id=user_id,
-                link=url,
-                media_type=download_type,
-                title=file_info['title'],
-                file_size=file_size,
-                status="completed"
-            )
-            session.add(history)
-            await session.commit()
+        # Mark the request logged by handle_message as completed
+        complete_download(user_id, url, file_info['title'], file_size)
         
         # Clean up progress message after delay
         await asyncio.sleep(5)
         await remove_message(progress_msg)
         
     except Exception as e:
-        logger.error(f"Download processing error: {e}")
+        logger.error("Download processing error: %s", e)
         
         error_text = f"""
 ❌ **Download Failed**
@@ -1445,26 +1658,26 @@ async def process_download_with_progress(query, context, url, quality, url_type,
         
         await add_reaction(progress_msg, "💥")
 
-async def handle_admin_callback(query, context, data, user_id, lang):
-    """Handle admin panel callbacks with enhanced Telegram-based admin features."""
-    try:
-        if data == "admin_stats":
-            # Enhanced live stats
-            async for session in get_db():
-                users_count = await session.scalar(select(User).count())
-                downloads_count = await session.scalar(select(DownloadHistory).count())
-                admins_count = await session.scalar(select(User).where(User.is_admin == True).count())
-                banned_count = await session.scalar(select(User).where(User.is_banned == True).count())
-                
-                # Get recent downloads
-                recent_downloads = await session.execute(
-                    select(DownloadHistory)
-                    .order_by(DownloadHistory.download_date.desc())
-                    .limit(5)
-                )
-                recent = recent_downloads.scalars().all()
-            
-            stats_text = f"""
+_ADMIN_STATS_TAIL = """
+📈 **System Health:**
+✅ All systems operational
+🔄 Auto-refresh every 30s
+
+💡 **Quick Actions:**
+"""
+
+_ADMIN_STATS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Refresh Now", callback_data="admin_stats")],
+    [InlineKeyboardButton("📊 Detailed Analytics", callback_data="admin_analytics")],
+    [InlineKeyboardButton("⬅️ Back to Main", callback_data="admin_back")]
+])
+
+async def _admin_stats(query, context, user_id, lang):
+    # Enhanced live stats
+    counts, recent = await get_admin_dashboard(5)
+    users_count, admins_count, banned_count, downloads_count = counts
+    
+    stats_text = f"""
 📊 **Live System Statistics**
 
 👥 **Total Users:** {users_count}
@@ -1474,35 +1687,12 @@ async def handle_admin_callback(query, context, data, user_id, lang):
 
 🎬 **Recent Activity:**
 """
-            
-            for download in recent:
-                title = download.title[:30] + "..." if len(download.title or "") > 30 else download.title or "Unknown"
-                stats_text += f"• {title} ({download.media_type})\n"
-            
-            stats_text += """
-📈 **System Health:**
-✅ All systems operational
-🔄 Auto-refresh every 30s
+    
+    stats_text = "".join((stats_text, format_recent(recent, 30), _ADMIN_STATS_TAIL))
+    
+    await query.edit_message_text(stats_text, reply_markup=_ADMIN_STATS_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
 
-💡 **Quick Actions:**
-"""
-            
-            keyboard = [
-                [InlineKeyboardButton("🔄 Refresh Now", callback_data="admin_stats")],
-                [InlineKeyboardButton("📊 Detailed Analytics", callback_data="admin_analytics")],
-                [InlineKeyboardButton("⬅️ Back to Main", callback_data="admin_back")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(stats_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        
-        elif data == "admin_vars":
-            # Enhanced variables management with inline actions
-            async for session in get_db():
-                result = await session.execute(select(Variable))
-                variables = result.scalars().all()
-            
-            vars_text = """
+_VARS_HEAD = """
 ⚙️ **Variable Management Center**
 
 📝 **Create/Update Variable:**
@@ -1516,28 +1706,39 @@ Send: `/getvar key`
 
 📋 **Current Variables:**
 """
-            
-            if variables:
-                for var in variables:
-                    desc = f"\n📋 {var.description}" if var.description else ""
-                    vars_text += f"🔑 `{var.key}`: `{var.value[:40]}{'...' if len(var.value) > 40 else ''}`{desc}\n\n"
-            else:
-                vars_text += "No variables defined yet.\n\n"
-            
-            vars_text += "💡 **Pro Tip:** Use variables to customize bot behavior and messages!"
-            
-            keyboard = [
-                [InlineKeyboardButton("🔄 Refresh List", callback_data="admin_vars")],
-                [InlineKeyboardButton("📝 Create Variable", callback_data="admin_create_var")],
-                [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(vars_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        
-        elif data == "admin_create_var":
-            # Guide for creating variables
-            create_var_text = """
+
+def _format_variable(var) -> str:
+    desc = f"\n📋 {var.description}" if var.description else ""
+    return f"🔑 `{var.key}`: `{var.value[:40]}{'...' if len(var.value) > 40 else ''}`{desc}\n\n"
+
+_ADMIN_VARS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Refresh List", callback_data="admin_vars")],
+    [InlineKeyboardButton("📝 Create Variable", callback_data="admin_create_var")],
+    [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
+])
+
+async def _admin_vars(query, context, user_id, lang):
+    # Enhanced variables management with inline actions
+    async with db_session() as session:
+        result = await session.execute(select(Variable))
+        variables = result.scalars().all()
+    
+    parts = [_VARS_HEAD]
+    if variables:
+        parts.extend(map(_format_variable, variables))
+    else:
+        parts.append("No variables defined yet.\n\n")
+    parts.append("💡 **Pro Tip:** Use variables to customize bot behavior and messages!")
+    vars_text = "".join(parts)
+    
+    await query.edit_message_text(vars_text, reply_markup=_ADMIN_VARS_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
+
+_ADMIN_CREATE_VAR_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 View All Variables", callback_data="admin_vars")],
+    [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
+])
+
+_ADMIN_CREATE_VAR_TEXT = """
 📝 **Create New Variable**
 
 📋 **Format:**
@@ -1555,24 +1756,24 @@ Send: `/getvar key`
 
 ⬅️ **Actions:**
 """
-            
-            keyboard = [
-                [InlineKeyboardButton("📋 View All Variables", callback_data="admin_vars")],
-                [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(create_var_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        
-        elif data == "admin_users":
-            # User management panel
-            async for session in get_db():
-                users_count = await session.scalar(select(User).count())
-                admins_count = await session.scalar(select(User).where(User.is_admin == True).count())
-                banned_count = await session.scalar(select(User).where(User.is_banned == True).count())
-                active_users = users_count - banned_count
-            
-            users_text = f"""
+
+async def _admin_create_var(query, context, user_id, lang):
+    await query.edit_message_text(_ADMIN_CREATE_VAR_TEXT, reply_markup=_ADMIN_CREATE_VAR_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
+
+_ADMIN_USERS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Refresh Stats", callback_data="admin_users")],
+    [InlineKeyboardButton("📊 View Stats", callback_data="admin_stats")],
+    [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
+])
+
+async def _admin_users(query, context, user_id, lang):
+    # User management panel
+    async with db_session() as session:
+        counts = await get_admin_counts(session)
+    users_count, admins_count, banned_count = counts.total, counts.admins, counts.banned
+    active_users = users_count - banned_count
+    
+    users_text = f"""
 👥 **User Management Center**
 
 📊 **User Statistics:**
@@ -1593,19 +1794,15 @@ Send: `/getvar key`
 
 💡 **Find User ID:** Forward a user's message to this bot to get their ID.
 """
-            
-            keyboard = [
-                [InlineKeyboardButton("🔄 Refresh Stats", callback_data="admin_users")],
-                [InlineKeyboardButton("📊 View Stats", callback_data="admin_stats")],
-                [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(users_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        
-        elif data == "admin_broadcast":
-            # Broadcast management
-            broadcast_text = """
+    
+    await query.edit_message_text(users_text, reply_markup=_ADMIN_USERS_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
+
+_ADMIN_BROADCAST_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Send Broadcast", callback_data="admin_send_broadcast")],
+    [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
+])
+
+_ADMIN_BROADCAST_TEXT = """
 📢 **Broadcast Management**
 
 🎯 **Send Broadcast:**
@@ -1623,18 +1820,16 @@ Use command: `/broadcast Your message here`
 
 ⚠️ **Important:** Broadcasts are sent to ALL users. Use responsibly!
 """
-            
-            keyboard = [
-                [InlineKeyboardButton("📝 Send Broadcast", callback_data="admin_send_broadcast")],
-                [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(broadcast_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        
-        elif data == "admin_send_broadcast":
-            # Guide for sending broadcast
-            send_broadcast_text = """
+
+async def _admin_broadcast(query, context, user_id, lang):
+    await query.edit_message_text(_ADMIN_BROADCAST_TEXT, reply_markup=_ADMIN_BROADCAST_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
+
+_ADMIN_SEND_BROADCAST_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📢 Send Now", callback_data="admin_back")],
+    [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
+])
+
+_ADMIN_SEND_BROADCAST_TEXT = """
 📢 **Send Broadcast Message**
 
 📝 **How to Send:**
@@ -1663,18 +1858,17 @@ Try it now: /start
 
 ⬅️ **Actions:**
 """
-            
-            keyboard = [
-                [InlineKeyboardButton("📢 Send Now", callback_data="admin_back")],
-                [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(send_broadcast_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        
-        elif data == "admin_settings":
-            # System settings
-            settings_text = """
+
+async def _admin_send_broadcast(query, context, user_id, lang):
+    await query.edit_message_text(_ADMIN_SEND_BROADCAST_TEXT, reply_markup=_ADMIN_SEND_BROADCAST_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
+
+_ADMIN_SETTINGS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⚙️ Variables", callback_data="admin_vars")],
+    [InlineKeyboardButton("📊 Stats", callback_data="admin_stats")],
+    [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
+])
+
+_ADMIN_SETTINGS_TEXT = """
 🔧 **System Settings & Configuration**
 
 📊 **Current Settings:**
@@ -1697,46 +1891,17 @@ Use variables to customize:
 
 🔄 **System Actions:**
 """
-            
-            keyboard = [
-                [InlineKeyboardButton("⚙️ Variables", callback_data="admin_vars")],
-                [InlineKeyboardButton("📊 Stats", callback_data="admin_stats")],
-                [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(settings_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        
-        elif data == "admin_analytics":
-            # Analytics dashboard
-            async for session in get_db():
-                # Get analytics data
-                total_downloads = await session.scalar(select(DownloadHistory).count())
-                
-                # Get downloads by platform (simplified)
-                youtube_downloads = await session.scalar(
-                    select(DownloadHistory).where(DownloadHistory.media_type == 'youtube').count()
-                )
-                instagram_downloads = await session.scalar(
-                    select(DownloadHistory).where(DownloadHistory.media_type.like('%instagram%')).count()
-                )
-            
-            # Calculate percentages safely
-            youtube_percent = (youtube_downloads / total_downloads * 100) if total_downloads > 0 else 0
-            instagram_percent = (instagram_downloads / total_downloads * 100) if total_downloads > 0 else 0
-            
-            analytics_text = f"""
-📈 **Analytics Dashboard**
 
-📊 **Download Statistics:**
-🎬 YouTube: {youtube_downloads} downloads
-📷 Instagram: {instagram_downloads} downloads
-📥 Total: {total_downloads} downloads
+async def _admin_settings(query, context, user_id, lang):
+    await query.edit_message_text(_ADMIN_SETTINGS_TEXT, reply_markup=_ADMIN_SETTINGS_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
 
-🎯 **Platform Distribution:**
-YouTube: {youtube_percent:.1f}%
-Instagram: {instagram_percent:.1f}%
+_ADMIN_ANALYTICS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Refresh Analytics", callback_data="admin_analytics")],
+    [InlineKeyboardButton("📊 Live Stats", callback_data="admin_stats")],
+    [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
+])
 
+_ADMIN_ANALYTICS_TAIL = """
 📊 **User Engagement:**
 • Active users: Calculating...
 • Daily downloads: Calculating...
@@ -1750,19 +1915,38 @@ Instagram: {instagram_percent:.1f}%
 
 🔄 **Data Updates:**
 """
-            
-            keyboard = [
-                [InlineKeyboardButton("🔄 Refresh Analytics", callback_data="admin_analytics")],
-                [InlineKeyboardButton("📊 Live Stats", callback_data="admin_stats")],
-                [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(analytics_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        
-        elif data == "admin_logs":
-            # Live logs (simulated for Telegram)
-            logs_text = """
+
+async def _admin_analytics(query, context, user_id, lang):
+    # Analytics dashboard
+    total_downloads, youtube_downloads, instagram_downloads = await get_analytics()
+    
+    # Calculate percentages safely
+    youtube_percent = (youtube_downloads / total_downloads * 100) if total_downloads > 0 else 0
+    instagram_percent = (instagram_downloads / total_downloads * 100) if total_downloads > 0 else 0
+    
+    analytics_text = f"""
+📈 **Analytics Dashboard**
+
+📊 **Download Statistics:**
+🎬 YouTube: {youtube_downloads} downloads
+📷 Instagram: {instagram_downloads} downloads
+📥 Total: {total_downloads} downloads
+
+🎯 **Platform Distribution:**
+YouTube: {youtube_percent:.1f}%
+Instagram: {instagram_percent:.1f}%
+""" + _ADMIN_ANALYTICS_TAIL
+    
+    await query.edit_message_text(analytics_text, reply_markup=_ADMIN_ANALYTICS_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
+
+_ADMIN_LOGS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Refresh Logs", callback_data="admin_logs")],
+    [InlineKeyboardButton("📊 View Stats", callback_data="admin_stats")],
+    [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
+])
+
+# Live logs (simulated for Telegram)
+_ADMIN_LOGS_TEXT = """
 📜 **Live System Logs**
 
 🔄 **Real-time Monitoring:**
@@ -1785,29 +1969,46 @@ Instagram: {instagram_percent:.1f}%
 
 ⚠️ **Note:** Full live logs available in web admin panel.
 """
-            
-            keyboard = [
-                [InlineKeyboardButton("🔄 Refresh Logs", callback_data="admin_logs")],
-                [InlineKeyboardButton("📊 View Stats", callback_data="admin_stats")],
-                [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(logs_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        
-        elif data == "admin_refresh":
-            # Refresh admin panel
-            await admin_command(query, context)
-        
-        elif data == "admin_back":
-            # Go back to main admin panel
-            await admin_command(query, context)
-        
-        elif data == "admin_close":
-            await query.edit_message_text("👋 Admin panel closed.")
-    
+
+async def _admin_logs(query, context, user_id, lang):
+    await query.edit_message_text(_ADMIN_LOGS_TEXT, reply_markup=_ADMIN_LOGS_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
+
+async def _admin_close(query, context, user_id, lang):
+    await query.edit_message_text("👋 Admin panel closed.")
+
+async def _admin_panel(query, context, user_id, lang):
+    await admin_command(query, context)
+
+# Admin panel callback data -> view
+ADMIN_CALLBACKS = {
+    "admin_stats": _admin_stats,
+    "admin_vars": _admin_vars,
+    "admin_create_var": _admin_create_var,
+    "admin_users": _admin_users,
+    "admin_broadcast": _admin_broadcast,
+    "admin_send_broadcast": _admin_send_broadcast,
+    "admin_settings": _admin_settings,
+    "admin_analytics": _admin_analytics,
+    "admin_logs": _admin_logs,
+    "admin_refresh": _admin_panel,
+    "admin_back": _admin_panel,
+    "admin_close": _admin_close,
+}
+
+async def handle_admin_callback(query, context, data, user_id, lang):
+    """Handle admin panel callbacks with enhanced Telegram-based admin features."""
+    view = ADMIN_CALLBACKS.get(data)
+    if view is None:
+        return
+    if not await is_admin(user_id):
+        return
+    try:
+        await view(query, context, user_id, lang)
     except Exception as e:
-        logger.error(f"Admin callback error: {e}")
+        # A refresh within ANALYTICS_TTL renders the same panel again
+        if isinstance(e, BadRequest) and "not modified" in e.message:
+            return
+        logger.error("Admin callback error: %s", e)
         await query.edit_message_text("❌ Error in admin panel")
         await add_reaction(query.message, "💥")
 
@@ -1815,24 +2016,47 @@ async def handle_broadcast_callback(query, context, data, user_id, lang):
     """Handle broadcast callbacks."""
     try:
         if data.startswith("broadcast_confirm_"):
-            # Extract original message from context (you'd need to store this)
-            # For now, we'll show confirmation
-            await query.edit_message_text("📢 **Broadcast Sent Successfully!**\n\n✅ Message delivered to all users.")
+            message = context.user_data.pop('broadcast_message', None)
+            if not message:
+                await query.edit_message_text("⏰ Session expired. Please use /broadcast again.")
+                return
+            
+            await query.edit_message_text("📢 **Sending broadcast...**", parse_mode=ParseMode.MARKDOWN)
+            # Sending can take N/30 seconds; run it outside the update handler
+            # so other chats' updates aren't held up
+            task = asyncio.get_running_loop().create_task(_run_broadcast(query, context.bot, message))
+            _broadcast_tasks.add(task)
+            task.add_done_callback(_broadcast_tasks.discard)
             
         elif data.startswith("broadcast_cancel_"):
+            context.user_data.pop('broadcast_message', None)
             await query.edit_message_text("❌ **Broadcast Cancelled**\n\nNo messages were sent.")
     
     except Exception as e:
-        logger.error(f"Broadcast callback error: {e}")
+        logger.error("Broadcast callback error: %s", e)
         await query.edit_message_text("❌ Error processing broadcast")
 
+# Callback data prefix (text before the first "_") -> (handler, whether the
+# data ends with the id of the only user allowed to press the button)
+CALLBACK_ROUTES = {
+    "lang": (handle_lang_callback, False),
+    "dl": (handle_dl_callback, True),
+    "admin": (handle_admin_callback, False),
+    "broadcast": (handle_broadcast_callback, True),
+}
+
 async def update_progress_message(message, text):
     """Update progress message with error handling."""
     try:
         await message.edit_text(text, parse_mode=ParseMode.MARKDOWN)
     except Exception as e:
-        logger.warning(f"Could not update progress message: {e}")
+        logger.warning("Could not update progress message: %s", e)
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error."""
-    logger.error(msg="Exception while handling an update:", exc_info=context.error)
+    error = context.error
+    # Transient Telegram/network failures come in bursts; skip the traceback
+    if isinstance(error, NetworkError):
+        logger.warning("Network error while handling an update: %s", error)
+        return
+    logger.error(msg="Exception while handling an update:", exc_info=error)
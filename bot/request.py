@@ -0,0 +1,15 @@
+import orjson
+from telegram.request import BaseRequest, HTTPXRequest
+
+
+class OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Telegram responses with orjson."""
+    __slots__ = ()
+
+    @staticmethod
+    def parse_json_payload(payload: bytes):
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # Let PTB's decoder handle (and report) anything orjson rejects
+            return BaseRequest.parse_json_payload(payload)
@@ -3,62 +3,101 @@ Cleanup mechanism for tmp folder - deletes files older than 30 minutes
 """
 
 import os
+import sys
 import time
-import threading
+import shutil
+import asyncio
+import logging
+import subprocess
+from collections import Counter
 from pathlib import Path
-from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
 
 # Configuration
 TMP_DIR = Path("tmp")
 CLEANUP_INTERVAL_MINUTES = 5  # Check every 5 minutes
 FILE_RETENTION_MINUTES = 30
 
+def _remove_old_entries(directory: str, cutoff: float, removed: Counter) -> bool:
+    """Delete files older than cutoff below directory, then emptied subdirectories.
+
+    Deletions are tallied in removed under "files" and "dirs". Returns
+    whether directory is empty afterwards.
+    """
+    empty = True
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if _remove_old_entries(entry.path, cutoff, removed):
+                    try:
+                        os.rmdir(entry.path)
+                        logger.debug("Deleted empty directory: %s", entry.path)
+                        removed["dirs"] += 1
+                        continue
+                    except OSError as e:
+                        logger.warning("Error deleting directory %s: %s", entry.path, e)
+            else:
+                try:
+                    # DirEntry caches the stat result from the directory read
+                    if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        logger.debug("Deleted old file: %s", entry.path)
+                        removed["files"] += 1
+                        continue
+                except OSError as e:
+                    logger.warning("Error deleting %s: %s", entry.path, e)
+            empty = False
+    return empty
+
+# GNU find walks, filters and unlinks in one process, without a Python-level
+# stat per file; elsewhere the scandir walk above is used
+_FIND = shutil.which("find") if sys.platform.startswith("linux") else None
+
+def _find_remove_old_entries(directory: str, removed: Counter):
+    """Same as _remove_old_entries, done by two find runs."""
+    for kind, test in (
+        ("files", ["-type", "f", "-mmin", f"+{FILE_RETENTION_MINUTES}"]),
+        ("dirs", ["-mindepth", "1", "-type", "d", "-empty"]),
+    ):
+        # -print after -delete lists only the entries actually removed
+        result = subprocess.run([_FIND, directory, *test, "-delete", "-print"],
+                                capture_output=True, check=False)
+        removed[kind] += result.stdout.count(b"\n")
+        if result.returncode:
+            logger.warning("find could not delete some %s: %s", kind, result.stderr.decode(errors="replace").strip())
+
 def cleanup_old_files():
     """Remove files older than FILE_RETENTION_MINUTES from tmp directory."""
     try:
-        now = datetime.now()
-        cutoff_time = now - timedelta(minutes=FILE_RETENTION_MINUTES)
-
         if not TMP_DIR.exists():
             return
 
-        # Walk through all files in tmp directory recursively
-        for file_path in TMP_DIR.rglob('*'):
-            if file_path.is_file():
-                # Check if file is older than cutoff
-                file_mtime = datetime.fromtimestamp(file_path.stat().st_mtime)
-                if file_mtime < cutoff_time:
-                    try:
-                        file_path.unlink()
-                        print(f"Deleted old file: {file_path}")
-                    except Exception as e:
-                        print(f"Error deleting {file_path}: {e}")
-
-        # Clean up empty directories
-        for dir_path in TMP_DIR.rglob('*'):
-            if dir_path.is_dir() and not any(dir_path.iterdir()):
-                try:
-                    dir_path.rmdir()
-                    print(f"Deleted empty directory: {dir_path}")
-                except Exception as e:
-                    print(f"Error deleting directory {dir_path}: {e}")
+        # One walk deletes old files and the directories they leave empty
+        started = time.time()
+        removed = Counter()
+        if _FIND:
+            _find_remove_old_entries(str(TMP_DIR), removed)
+        else:
+            _remove_old_entries(str(TMP_DIR), started - FILE_RETENTION_MINUTES * 60, removed)
+        if removed:
+            logger.info("Cleanup removed %d files, %d dirs in %.2fs",
+                        removed["files"], removed["dirs"], time.time() - started)
 
     except Exception as e:
-        print(f"Error during cleanup: {e}")
+        logger.error("Error during cleanup: %s", e)
 
-def cleanup_loop():
-    """Run cleanup in a loop every CLEANUP_INTERVAL_MINUTES."""
-    while True:
-        cleanup_old_files()
-        time.sleep(CLEANUP_INTERVAL_MINUTES * 60)
+async def cleanup_periodically():
+    """Run cleanup every CLEANUP_INTERVAL_MINUTES on the running event loop.
 
-def start_cleanup_thread():
-    """Start the cleanup thread."""
-    cleanup_thread = threading.Thread(target=cleanup_loop, daemon=True)
-    cleanup_thread.start()
-    print("Cleanup thread started")
+    Only the filesystem walk leaves the loop, on the default executor.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await loop.run_in_executor(None, cleanup_old_files)
+        await asyncio.sleep(CLEANUP_INTERVAL_MINUTES * 60)
 
 if __name__ == "__main__":
-    # Run cleanup once and then start the loop
-    cleanup_old_files()
-    cleanup_loop()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    # Run cleanup once and then keep running it periodically
+    asyncio.run(cleanup_periodically())
@@ -17,6 +17,7 @@ LOCALES = {
         "banned": "You have been banned from using this bot.",
         "processing": "Processing... ⚙️",
         "searching": "Searching... 🔎",
+        "info_ready": "Media info ready ✅",
         "found": "🎬 **{title}**\n\nSelect quality:",
         "quality_best": "Best Quality 🌟",
         "quality_1080": "1080p 🖥️",
@@ -39,6 +40,7 @@ LOCALES = {
         "banned": "شما از استفاده از ربات مسدود شده‌اید.",
         "processing": "در حال پردازش... ⚙️",
         "searching": "در حال جستجو... 🔎",
+        "info_ready": "اطلاعات رسانه آماده است ✅",
         "found": "🎬 **{title}**\n\nکیفیت را انتخاب کنید:",
         "quality_best": "بهترین کیفیت 🌟",
         "quality_1080": "1080p 🖥️",
@@ -47,10 +49,25 @@ LOCALES = {
     }
 }
 
+# Flat (lang, key) -> text tables, built once. Keys a language lacks are
+# filled from English, so lookups need no fallback step. Most strings have
+# no placeholders and are returned straight from _STATIC.
+_STATIC = {}
+_FORMAT = {}
+for _lang, _strings in LOCALES.items():
+    for _key, _text in {**LOCALES["en"], **_strings}.items():
+        (_FORMAT if "{" in _text else _STATIC)[_lang, _key] = _text
+
 def t(key: str, lang: str = "fa", **kwargs) -> str:
-    """Get translated string."""
-    lang_dict = LOCALES.get(lang, LOCALES["en"])
-    text = lang_dict.get(key, key)
+    """Get translated string, falling back to English, then to the key itself."""
+    text = _STATIC.get((lang, key))
+    if text is not None:
+        return text
+    text = _FORMAT.get((lang, key))
+    if text is None:
+        if lang not in LOCALES:
+            return t(key, "en", **kwargs)
+        return key
     if kwargs:
         return text.format(**kwargs)
     return text
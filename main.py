@@ -20,10 +20,12 @@ import zipfile
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any, Union
 from pathlib import Path
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from urllib.parse import urlparse
 
-from fastapi import FastAPI, HTTPException, Query, BackgroundTasks, Request, APIRouter
+from fastapi import FastAPI, HTTPException, Query, BackgroundTasks, Request, APIRouter, WebSocket
 from fastapi.responses import FileResponse, StreamingResponse, RedirectResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
@@ -32,12 +34,14 @@ import yt_dlp
 import aiofiles
 import yt_dlp
 import aiofiles
-from cleanup import start_cleanup_thread
-from database import init_db, get_db, User, Variable, DownloadHistory
+from cleanup import cleanup_periodically
+from database import init_db, get_db, db_session, flush_history, sync_download_counters, dialect_insert, User, Variable, DownloadHistory
 from bot import core as bot_core
-from sqlalchemy import select, delete
-import websockets
+from sqlalchemy import select, delete, func, bindparam
+from sqlalchemy.orm import undefer
+from cachetools import TTLCache
 import json
+import orjson
 import logging
 import asyncio
 from typing import Dict, List, Any
@@ -49,6 +53,20 @@ DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
 INSTAGRAM_DOWNLOAD_DIR = Path("tmp/instagram")
 INSTAGRAM_DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
+# yt-dlp metadata extraction blocks on network and parsing, so it runs on
+# its own bounded pool; downloads keep using the default executor
+YTDLP_INFO_WORKERS = 8
+ytdlp_pool = ThreadPoolExecutor(max_workers=YTDLP_INFO_WORKERS, thread_name_prefix="yt-dlp-info")
+
+def _extract_info_sync(url: str, ydl_opts: dict):
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return ydl.extract_info(url, download=False)
+
+async def extract_info(url: str, ydl_opts: dict):
+    """Run yt-dlp's extract_info(url, download=False) on ytdlp_pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(ytdlp_pool, _extract_info_sync, url, ydl_opts)
+
 CLEANUP_TIMEOUT_MINUTES = 30
 MAX_REQUESTS_PER_MINUTE = 30
 
@@ -73,7 +91,8 @@ app.add_middleware(
 
 
 # Live logging system
-live_logs: List[Dict[str, Any]] = []
+LIVE_LOG_LIMIT = 1000 # Entries kept for /api/logs and new log clients
+live_logs: deque = deque(maxlen=LIVE_LOG_LIMIT)
 log_clients: List = []
 
 # Enhanced job tracking with live updates
@@ -82,50 +101,95 @@ app.include_router(instagram_router)
 app.include_router(admin_router)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
-rate_limit_store: Dict[str, List[float]] = defaultdict(list)
+rate_limit_store: Dict[str, deque] = defaultdict(deque) # Request times per IP, oldest first
+
+_now_iso_cache = [0, ""] # Epoch second and its formatted timestamp
+
+def now_iso() -> str:
+    """Current local time as an ISO string, to the second; formatted once per second."""
+    second = int(time.time())
+    if second != _now_iso_cache[0]:
+        _now_iso_cache[:] = (second, datetime.fromtimestamp(second).isoformat())
+    return _now_iso_cache[1]
+
+def recent_live_logs(limit: int) -> List[Dict[str, Any]]:
+    """Return the newest limit entries of live_logs, oldest first."""
+    # emit appends from other threads; copy in one call before slicing
+    snapshot = tuple(live_logs)
+    return list(snapshot[max(0, len(snapshot) - limit):])
+
+# Log entries waiting to be broadcast; set up by log_broadcast_worker() on
+# the server's loop, and bounded so a stalled broadcast drops the oldest
+LOG_QUEUE_SIZE = 10000
+log_queue: Optional[asyncio.Queue] = None
+log_loop: Optional[asyncio.AbstractEventLoop] = None
+
+# A client that takes longer than this to accept a frame is dropped, and at
+# most BROADCAST_CONCURRENCY sends are in flight at once
+BROADCAST_SEND_TIMEOUT = 5.0
+BROADCAST_CONCURRENCY = 100
+
+def _queue_log(log_entry):
+    if log_queue.full():
+        log_queue.get_nowait()
+    log_queue.put_nowait(log_entry)
 
 # Custom logging handler for live updates
 class LiveLogHandler(logging.Handler):
     def emit(self, record):
         log_entry = {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": now_iso(),
             "level": record.levelname,
             "message": self.format(record),
             "module": record.module,
             "function": record.funcName,
             "line": record.lineno
         }
-        live_logs.append(log_entry)
-        # Keep only last 1000 logs
-        if len(live_logs) > 1000:
-            live_logs.pop(0)
-        
-        # Broadcast to WebSocket clients
-        asyncio.create_task(self.broadcast_log(log_entry))
-    
-    async def broadcast_log(self, log_entry):
-        """Broadcast log entry to all connected WebSocket clients."""
-        if log_clients:
-            message = json.dumps({"type": "log", "data": log_entry})
-            disconnected_clients = []
-            
-            for client in log_clients:
-                try:
-                    await client.send(message)
-                except websockets.exceptions.ConnectionClosed:
-                    disconnected_clients.append(client)
-                except Exception:
-                    disconnected_clients.append(client)
-            
-            # Remove disconnected clients
-            for client in disconnected_clients:
-                if client in log_clients:
-                    log_clients.remove(client)
+        live_logs.append(log_entry) # The deque drops the oldest entry itself
+        
+        # Hand off to the broadcaster; records may come from executor threads
+        if log_loop is not None and log_clients:
+            log_loop.call_soon_threadsafe(_queue_log, log_entry)
+
+def ws_frame(kind: str, data) -> str:
+    """Serialize a {"type": kind, "data": data} WebSocket text frame."""
+    return orjson.dumps({"type": kind, "data": data}).decode()
+
+async def _safe_send(client, message, semaphore) -> bool:
+    """Send message to one client; return whether it went through in time."""
+    async with semaphore:
+        try:
+            await asyncio.wait_for(client.send_text(message), timeout=BROADCAST_SEND_TIMEOUT)
+            return True
+        except Exception:
+            return False
+
+async def log_broadcast_worker():
+    """Broadcast queued log entries to WebSocket clients, batching whatever piled up."""
+    global log_queue, log_loop
+    log_queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+    log_loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    while True:
+        batch = [await log_queue.get()]
+        while not log_queue.empty():
+            batch.append(log_queue.get_nowait())
+        if not log_clients:
+            continue
+        message = ws_frame("logs", batch)
+        clients = list(log_clients)
+        sent = await asyncio.gather(*[_safe_send(client, message, semaphore) for client in clients])
+        
+        # Remove disconnected and stalled clients
+        failed = {client for client, ok in zip(clients, sent) if not ok}
+        if failed:
+            log_clients[:] = [client for client in log_clients if client not in failed]
 
 # Setup live logging
 live_handler = LiveLogHandler()
 logging.getLogger().addHandler(live_handler)
-logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
 
 class DownloadRequest(BaseModel):
@@ -206,12 +270,22 @@ def check_rate_limit(ip: str) -> bool:
     """Check if IP has exceeded rate limit."""
     now = time.time()
     minute_ago = now - 60
-    rate_limit_store[ip] = [t for t in rate_limit_store[ip] if t > minute_ago]
-    if len(rate_limit_store[ip]) >= MAX_REQUESTS_PER_MINUTE:
+    requests = rate_limit_store[ip]
+    while requests and requests[0] <= minute_ago:
+        requests.popleft()
+    if len(requests) >= MAX_REQUESTS_PER_MINUTE:
         return False
-    rate_limit_store[ip].append(now)
+    requests.append(now)
     return True
 
+async def sweep_rate_limits():
+    """Drop IPs without requests in the last minute, so the store doesn't grow forever."""
+    while True:
+        await asyncio.sleep(60)
+        minute_ago = time.time() - 60
+        for ip in [ip for ip, requests in rate_limit_store.items() if not requests or requests[-1] <= minute_ago]:
+            del rate_limit_store[ip]
+
 
 def get_format_string(quality: Optional[str], download_type: Optional[str]) -> str:
     """Convert quality preference to yt-dlp format string."""
@@ -321,23 +395,24 @@ async def startup_event():
     """Clean up old files on startup."""
     app.startup_time = time.time()
     await cleanup_old_files()
-    start_cleanup_thread()
+    app.cleanup_task = asyncio.create_task(cleanup_periodically())
+    app.log_task = asyncio.create_task(log_broadcast_worker())
+    app.rate_limit_task = asyncio.create_task(sweep_rate_limits())
     await init_db()
     # Initialize bot
     asyncio.create_task(bot_core.run_bot())
 
 # WebSocket endpoint for live logs
 @app.websocket("/ws/logs")
-async def websocket_logs(websocket):
+async def websocket_logs(websocket: WebSocket):
     """WebSocket endpoint for real-time log streaming."""
     await websocket.accept()
     log_clients.append(websocket)
     
     try:
         # Send recent logs to new client
-        recent_logs = live_logs[-100:] if len(live_logs) > 100 else live_logs
-        for log_entry in recent_logs:
-            await websocket.send(json.dumps({"type": "log", "data": log_entry}))
+        recent_logs = recent_live_logs(100)
+        await websocket.send_text(ws_frame("logs", recent_logs))
         
         # Keep connection alive
         while True:
@@ -350,29 +425,29 @@ async def websocket_logs(websocket):
             log_clients.remove(websocket)
 
 # Admin WebSocket endpoint for real-time updates
+ADMIN_UPDATE_INTERVAL = 2 # Seconds between updates while stats are changing
+ADMIN_IDLE_INTERVAL = 5 # Seconds between polls once an update changed nothing
+
 @app.websocket("/ws/admin")
-async def websocket_admin(websocket):
+async def websocket_admin(websocket: WebSocket):
     """WebSocket endpoint for admin panel real-time updates."""
     await websocket.accept()
     
+    last_frame = None
     try:
         while True:
-            # Send real-time stats
+            # Real-time stats and recent logs, in one frame
             stats = await get_stats()
-            await websocket.send(json.dumps({
-                "type": "stats",
-                "data": stats
-            }))
-            
-            # Send recent logs
-            recent_logs = live_logs[-50:] if len(live_logs) > 50 else live_logs
-            await websocket.send(json.dumps({
-                "type": "logs",
-                "data": recent_logs
-            }))
-            
-            # Wait before next update
-            await asyncio.sleep(2)
+            recent_logs = recent_live_logs(50)
+            frame = ws_frame("admin_update", {"stats": stats, "logs": recent_logs})
+            
+            # Skip unchanged updates and poll less often until something changes
+            if frame != last_frame:
+                await websocket.send_text(frame)
+                last_frame = frame
+                await asyncio.sleep(ADMIN_UPDATE_INTERVAL)
+            else:
+                await asyncio.sleep(ADMIN_IDLE_INTERVAL)
     except:
         pass
 
@@ -386,26 +461,32 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {"status": "healthy", "timestamp": now_iso()}
 
 # API endpoints for logs
 @app.get("/api/logs")
 async def get_logs(limit: int = Query(default=100, ge=1, le=1000)):
     """Get recent logs."""
     return {
-        "logs": live_logs[-limit:] if len(live_logs) > limit else live_logs,
+        "logs": recent_live_logs(limit),
         "total": len(live_logs)
     }
 
 @app.get("/api/logs/search")
 async def search_logs(query: str = Query(..., min_length=1), limit: int = Query(default=100, ge=1, le=1000)):
-    """Search logs by content."""
-    filtered_logs = [
-        log for log in live_logs
-        if query.lower() in log["message"].lower() or query.lower() in log["module"].lower()
-    ]
+    """Search logs by content; returns up to limit of the newest matches."""
+    needle = query.lower()
+    # Walk a snapshot (emit appends from other threads) newest first and
+    # stop once limit matches are found
+    snapshot = tuple(live_logs)
+    matches = (
+        log for log in reversed(snapshot)
+        if needle in log["message"].lower() or needle in log["module"].lower()
+    )
+    filtered_logs = list(islice(matches, limit))
+    filtered_logs.reverse()
     return {
-        "logs": filtered_logs[-limit:] if len(filtered_logs) > limit else filtered_logs,
+        "logs": filtered_logs,
         "total": len(filtered_logs),
         "query": query
     }
@@ -434,33 +515,32 @@ async def get_video_info(request: Request, url: str = Query(..., description="Yo
             "ignoreerrors": True,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
+        info = await extract_info(url, ydl_opts)
+        
+        if info is None:
+            raise HTTPException(status_code=400, detail="Could not extract video information. The video may be private, age-restricted, or unavailable.")
+        
+        if info.get("_type") == "playlist":
+            entries = info.get("entries", [])
+            videos = []
+            for entry in entries:
+                if entry:
+                    videos.append(extract_video_info(entry))
             
-            if info is None:
-                raise HTTPException(status_code=400, detail="Could not extract video information. The video may be private, age-restricted, or unavailable.")
+            return {
+                "type": "playlist",
+                "playlist_id": info.get("id"),
+                "playlist_title": info.get("title"),
+                "playlist_count": len(videos),
+                "uploader": info.get("uploader"),
+                "videos": videos
+            }
+        else:
+            return {
+                "type": "video",
+                **extract_video_info(info)
+            }
             
-            if info.get("_type") == "playlist":
-                entries = info.get("entries", [])
-                videos = []
-                for entry in entries:
-                    if entry:
-                        videos.append(extract_video_info(entry))
-                
-                return {
-                    "type": "playlist",
-                    "playlist_id": info.get("id"),
-                    "playlist_title": info.get("title"),
-                    "playlist_count": len(videos),
-                    "uploader": info.get("uploader"),
-                    "videos": videos
-                }
-            else:
-                return {
-                    "type": "video",
-                    **extract_video_info(info)
-                }
-                
     except yt_dlp.utils.DownloadError as e:
         error_msg = str(e)
         if "Private video" in error_msg:
@@ -492,119 +572,144 @@ async def get_formats(request: Request, url: str = Query(..., description="YouTu
             "no_warnings": True,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            if info is None:
-                raise HTTPException(status_code=400, detail="Could not extract format information.")
-            
-            formats = info.get("formats", [])
-            
-            video_only = []
-            audio_only = []
-            combined = []
-            
-            for fmt in formats:
-                fmt_info = extract_format_info(fmt)
-                vcodec = fmt.get("vcodec", "none")
-                acodec = fmt.get("acodec", "none")
-                
-                if vcodec != "none" and acodec != "none":
-                    combined.append(fmt_info)
-                elif vcodec != "none":
-                    video_only.append(fmt_info)
-                elif acodec != "none":
-                    audio_only.append(fmt_info)
+        info = await extract_info(url, ydl_opts)
+        
+        if info is None:
+            raise HTTPException(status_code=400, detail="Could not extract format information.")
+        
+        formats = info.get("formats", [])
+        
+        video_only = []
+        audio_only = []
+        combined = []
+        
+        for fmt in formats:
+            fmt_info = extract_format_info(fmt)
+            vcodec = fmt.get("vcodec", "none")
+            acodec = fmt.get("acodec", "none")
             
-            return {
-                "video_id": info.get("id"),
-                "title": info.get("title"),
-                "formats": {
-                    "video_only": video_only,
-                    "audio_only": audio_only,
-                    "combined": combined
-                },
-                "recommended": {
-                    "best_video": "bestvideo+bestaudio/best",
-                    "best_audio": "bestaudio/best",
-                    "720p": "bestvideo[height<=720]+bestaudio",
-                    "1080p": "bestvideo[height<=1080]+bestaudio",
-                }
+            if vcodec != "none" and acodec != "none":
+                combined.append(fmt_info)
+            elif vcodec != "none":
+                video_only.append(fmt_info)
+            elif acodec != "none":
+                audio_only.append(fmt_info)
+        
+        return {
+            "video_id": info.get("id"),
+            "title": info.get("title"),
+            "formats": {
+                "video_only": video_only,
+                "audio_only": audio_only,
+                "combined": combined
+            },
+            "recommended": {
+                "best_video": "bestvideo+bestaudio/best",
+                "best_audio": "bestaudio/best",
+                "720p": "bestvideo[height<=720]+bestaudio",
+                "1080p": "bestvideo[height<=1080]+bestaudio",
             }
-            
+        }
+        
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting formats: {str(e)}")
 
 
 # --- Admin API ---
 
+# System-wide counts for /admin/stats: one scan of each table, with
+# "today" bound per request
+_USER_STATS = select(
+    func.count().label("total"),
+    func.count().filter(User.is_admin == True).label("admins"),
+    func.count().filter(User.is_banned == True).label("banned"),
+    func.count().filter(User.joined_date >= bindparam("today")).label("today"),
+    func.count().filter(User.is_banned == True, User.joined_date >= bindparam("today")).label("banned_today"),
+).select_from(User)
+
+_DOWNLOAD_STATS = select(
+    func.count().label("total"),
+    func.count().filter(DownloadHistory.download_date >= bindparam("today")).label("today"),
+).select_from(DownloadHistory)
+
+_RECENT_DOWNLOADS = (
+    select(DownloadHistory)
+    .options(undefer(DownloadHistory.title), undefer(DownloadHistory.link))
+    .order_by(DownloadHistory.download_date.desc()).limit(10)
+)
+
+# Size of the download directory is recomputed at most every STORAGE_TTL
+# seconds; the admin socket asks for stats every 2s
+STORAGE_TTL = 30
+_storage_cache = TTLCache(maxsize=1, ttl=STORAGE_TTL)
+
+def storage_used() -> int:
+    """Total size in bytes of the files in DOWNLOAD_DIR."""
+    used = _storage_cache.get("bytes")
+    if used is None:
+        used = 0
+        with os.scandir(DOWNLOAD_DIR) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    used += entry.stat().st_size
+        _storage_cache["bytes"] = used
+    return used
+
+async def _fetch_stats(stmt, **params):
+    # Own session per query so get_stats can run them concurrently
+    async with db_session() as session:
+        return await session.execute(stmt, params)
+
 @admin_router.get("/stats")
 async def get_stats():
     """Get comprehensive system statistics."""
-    async for session in get_db():
-        # Get basic counts
-        total_users = await session.scalar(select(User).count())
-        total_downloads = await session.scalar(select(DownloadHistory).count())
-        total_admins = await session.scalar(select(User).where(User.is_admin == True).count())
-        total_banned = await session.scalar(select(User).where(User.is_banned == True).count())
-        
-        # Get today's activity
-        today = datetime.now().date()
-        users_today = await session.scalar(
-            select(User).where(User.created_at >= today).count()
-        )
-        downloads_today = await session.scalar(
-            select(DownloadHistory).where(DownloadHistory.download_date >= today).count()
-        )
-        banned_today = await session.scalar(
-            select(User).where(User.is_banned == True, User.created_at >= today).count()
-        )
-        
-        # Get recent downloads
-        history = await session.execute(
-            select(DownloadHistory).order_by(DownloadHistory.download_date.desc()).limit(10)
-        )
-        recent_downloads = [
-            {
-                "title": h.title,
-                "media_type": h.media_type,
-                "date": h.download_date.isoformat(),
-                "link": h.link
-            }
-            for h in history.scalars().all()
-        ]
-        
-        # Calculate active downloads (jobs still processing)
-        active_downloads = len([job for job in jobs.values() if job.get("status") in ["pending", "processing"]])
-        
-        # Calculate storage usage
-        storage_used = sum(
-            os.path.getsize(f) for f in DOWNLOAD_DIR.glob("*") if f.is_file()
-        )
-        
-        # Count API requests (approximate)
-        api_requests = len([t for t in rate_limit_store.get("*", []) if time.time() - t < 3600])
-        
-        # Calculate uptime
-        uptime_seconds = time.time() - app.startup_time if hasattr(app, 'startup_time') else 0
-        uptime_hours = int(uptime_seconds // 3600)
-        uptime_minutes = int((uptime_seconds % 3600) // 60)
-        
-        return {
-            "total_users": total_users,
-            "total_downloads": total_downloads,
-            "total_admins": total_admins,
-            "total_banned": total_banned,
-            "users_today": users_today,
-            "downloads_today": downloads_today,
-            "new_admins": 0,  # TODO: Track admin promotions
-            "banned_today": banned_today,
-            "active_downloads": active_downloads,
-            "storage_used": storage_used,
-            "api_requests": api_requests,
-            "uptime": f"{uptime_hours}h {uptime_minutes}m",
-            "recent_downloads": recent_downloads
+    # Start of today, as a datetime to match the timestamp columns
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    user_result, download_result, history = await asyncio.gather(
+        _fetch_stats(_USER_STATS, today=today),
+        _fetch_stats(_DOWNLOAD_STATS, today=today),
+        _fetch_stats(_RECENT_DOWNLOADS),
+    )
+    users = user_result.one()
+    downloads = download_result.one()
+    
+    recent_downloads = [
+        {
+            "title": h.title,
+            "media_type": h.media_type,
+            "date": h.download_date.isoformat(),
+            "link": h.link
         }
+        for h in history.scalars().all()
+    ]
+    
+    # Calculate active downloads (jobs still processing)
+    active_downloads = len([job for job in jobs.values() if job.get("status") in ["pending", "processing"]])
+
+
+    # Count API requests (approximate)
+    api_requests = len([t for t in rate_limit_store.get("*", []) if time.time() - t < 3600])
+
+    # Calculate uptime
+    uptime_seconds = time.time() - app.startup_time if hasattr(app, 'startup_time') else 0
+    uptime_hours = int(uptime_seconds // 3600)
+    uptime_minutes = int((uptime_seconds % 3600) // 60)
+
+    return {
+        "total_users": users.total,
+        "total_downloads": downloads.total,
+        "total_admins": users.admins,
+        "total_banned": users.banned,
+        "users_today": users.today,
+        "downloads_today": downloads.today,
+        "new_admins": 0,  # TODO: Track admin promotions
+        "banned_today": users.banned_today,
+        "active_downloads": active_downloads,
+        "storage_used": storage_used(),
+        "api_requests": api_requests,
+        "uptime": f"{uptime_hours}h {uptime_minutes}m",
+        "recent_downloads": recent_downloads
+    }
 
 class VariableModel(BaseModel):
     key: str
@@ -651,6 +756,12 @@ async def get_users():
             for user in users
         ]
 
+def invalidate_user_state(user_id: int):
+    """Drop the bot's cached flags for a user changed through the admin API."""
+    # Imported here, bot.handlers imports this module
+    from bot.handlers import invalidate_user_state as invalidate
+    invalidate(user_id)
+
 @admin_router.post("/users/{user_id}/ban")
 async def ban_user(user_id: int):
     """Ban a user."""
@@ -666,6 +777,7 @@ async def ban_user(user_id: int):
         
         user.is_banned = True
         await session.commit()
+        invalidate_user_state(user_id)
         
     return {"status": "success", "message": f"User {user_id} has been banned"}
 
@@ -681,6 +793,7 @@ async def unban_user(user_id: int):
         
         user.is_banned = False
         await session.commit()
+        invalidate_user_state(user_id)
         
     return {"status": "success", "message": f"User {user_id} has been unbanned"}
 
@@ -699,6 +812,7 @@ async def promote_user(user_id: int):
         
         user.is_admin = True
         await session.commit()
+        invalidate_user_state(user_id)
         
     return {"status": "success", "message": f"User {user_id} has been promoted to admin"}
 
@@ -717,6 +831,7 @@ async def demote_user(user_id: int):
         
         user.is_admin = False
         await session.commit()
+        invalidate_user_state(user_id)
         
     return {"status": "success", "message": f"Admin {user_id} has been demoted to user"}
 
@@ -739,23 +854,13 @@ async def get_variables():
 @admin_router.post("/variables")
 async def create_variable(var: VariableModel):
     """Create or update a variable."""
+    stmt = dialect_insert(Variable).values(key=var.key, value=var.value, description=var.description)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Variable.key],
+        set_={"value": stmt.excluded.value, "description": stmt.excluded.description},
+    )
     async for session in get_db():
-        result = await session.execute(select(Variable).where(Variable.key == var.key))
-        existing = result.scalar_one_or_none()
-        
-        if existing:
-            existing.value = var.value
-            existing.description = var.description
-            existing.updated_at = datetime.now()
-        else:
-            session.add(Variable(
-                key=var.key,
-                value=var.value,
-                description=var.description,
-                created_at=datetime.now(),
-                updated_at=datetime.now()
-            ))
-        
+        await session.execute(stmt)
         await session.commit()
     return {"status": "success", "message": "Variable saved successfully"}
 
@@ -780,8 +885,10 @@ class BroadcastRequest(BaseModel):
 @admin_router.post("/broadcast")
 async def broadcast_message(req: BroadcastRequest):
     """Broadcast message to all users."""
-    if not bot_core.bot_app:
+    ctx = bot_core.ctx
+    if not ctx:
         raise HTTPException(503, "Bot not initialized")
+    send_message = ctx.bot.send_message
         
     count = 0
     errors = 0
@@ -792,7 +899,7 @@ async def broadcast_message(req: BroadcastRequest):
         
     for user_id in users:
         try:
-             await bot_core.bot_app.bot.send_message(chat_id=user_id, text=req.message)
+             await send_message(chat_id=user_id, text=req.message)
              count += 1
         except Exception as e:
             errors += 1
@@ -808,6 +915,7 @@ async def get_recent_activity():
     async for session in get_db():
         result = await session.execute(
             select(DownloadHistory)
+            .options(undefer(DownloadHistory.title))
             .order_by(DownloadHistory.download_date.desc())
             .limit(5)
         )
@@ -825,7 +933,7 @@ async def get_recent_activity():
         activities.append({
             "type": "admin_action",
             "title": "Admin panel accessed",
-            "timestamp": datetime.now().isoformat()
+            "timestamp": now_iso()
         })
     
     return activities[:10]
@@ -842,53 +950,45 @@ async def get_analytics(period: int = Query(default=30, description="Period in d
     start_date = datetime.now() - timedelta(days=period)
     
     async for session in get_db():
-        # Download analytics
-        downloads_result = await session.execute(
-            select(DownloadHistory)
+        # Platform distribution, counted by the database
+        platform_result = await session.execute(
+            select(DownloadHistory.media_type, func.count())
             .where(DownloadHistory.download_date >= start_date)
+            .group_by(DownloadHistory.media_type)
         )
-        downloads = downloads_result.scalars().all()
-        
-        # User analytics
-        users_result = await session.execute(
-            select(User)
-            .where(User.created_at >= start_date)
+        platform_counts = Counter()
+        for platform, count in platform_result:
+            platform_counts[platform or "unknown"] += count
+        total_downloads = sum(platform_counts.values())
+        
+        # Daily downloads and new users; only the date column is loaded
+        download_dates = await session.scalars(
+            select(DownloadHistory.download_date)
+            .where(DownloadHistory.download_date >= start_date)
         )
-        new_users = users_result.scalars().all()
-        
-        # Platform distribution
-        platform_counts = {}
-        for download in downloads:
-            platform = download.platform or "unknown"
-            platform_counts[platform] = platform_counts.get(platform, 0) + 1
-        
-        # Daily downloads
-        daily_downloads = {}
-        for download in downloads:
-            date_key = download.download_date.date().isoformat()
-            daily_downloads[date_key] = daily_downloads.get(date_key, 0) + 1
+        daily_downloads = Counter(date.date().isoformat() for date in download_dates)
         
-        # Daily new users
-        daily_users = {}
-        for user in new_users:
-            date_key = user.created_at.date().isoformat()
-            daily_users[date_key] = daily_users.get(date_key, 0) + 1
+        join_dates = await session.scalars(
+            select(User.joined_date)
+            .where(User.joined_date >= start_date)
+        )
+        daily_users = Counter(date.date().isoformat() for date in join_dates)
         
         return {
             "period_days": period,
             "downloads": {
-                "total": len(downloads),
+                "total": total_downloads,
                 "labels": sorted(daily_downloads.keys()),
                 "data": [daily_downloads[date] for date in sorted(daily_downloads.keys())]
             },
             "users": {
-                "total": len(new_users),
+                "total": sum(daily_users.values()),
                 "labels": sorted(daily_users.keys()),
                 "data": [daily_users[date] for date in sorted(daily_users.keys())]
             },
-            "platforms": platform_counts,
+            "platforms": dict(platform_counts),
             "popular_platform": max(platform_counts.items(), key=lambda x: x[1])[0] if platform_counts else "unknown",
-            "avg_daily_downloads": round(len(downloads) / period, 1) if period > 0 else 0,
+            "avg_daily_downloads": round(total_downloads / period, 1) if period > 0 else 0,
             "peak_hour": "14:00",  # TODO: Calculate actual peak hour
             "most_active_user": "N/A"  # TODO: Calculate most active user
         }
@@ -924,6 +1024,7 @@ async def cleanup_database():
             await session.execute(
                 delete(DownloadHistory).where(DownloadHistory.download_date < cutoff_date)
             )
+            await sync_download_counters(session)
             await session.commit()
         
         return {"status": "success", "message": "Database cleanup completed"}
@@ -944,6 +1045,7 @@ async def reset_database():
         async for session in get_db():
             await session.execute(delete(DownloadHistory))
             await session.execute(delete(User).where(User.is_admin == False))  # Keep admins
+            await sync_download_counters(session)
             await session.commit()
         
         return {"status": "success", "message": "Database reset completed"}
@@ -995,14 +1097,8 @@ async def internal_get_formats(url: str) -> dict:
         "extract_flat": "in_playlist", # Don't extract full playlist items
     }
     
-    loop = asyncio.get_event_loop()
-    
-    def _extract():
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            return ydl.extract_info(url, download=False)
-            
     try:
-        info = await loop.run_in_executor(None, _extract)
+        info = await extract_info(url, ydl_opts)
         if not info:
              raise Exception("No info extraction")
              
@@ -1034,26 +1130,33 @@ async def internal_download_video(url: str, quality: Optional[str] = "best", for
         ydl_opts["progress_hooks"] = progress_hooks
         
     # Run in thread pool to avoid blocking async loop
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     
     def _download():
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            return ydl.extract_info(url, download=True)
+            info = ydl.extract_info(url, download=True)
+        # Stat the results on this thread too, callers get the size for free
+        return info, [(path, path.stat().st_size) for path in DOWNLOAD_DIR.glob(f"{file_id}_*")]
             
-    info = await loop.run_in_executor(None, _download)
+    info, downloaded_files = await loop.run_in_executor(None, _download)
     
     if info:
-        downloaded_files = list(DOWNLOAD_DIR.glob(f"{file_id}_*"))
         if not downloaded_files:
              raise Exception("Download finished but file not found.")
              
-        # Find the main file (largest usually, or just the first)
-        main_file = downloaded_files[0]
+        # The main file is the largest one; a .jpg written next to it is its thumbnail
+        main_file, file_size = max(downloaded_files, key=lambda item: item[1])
+        thumbnail_path = next(
+            (str(path) for path, _ in downloaded_files if path != main_file and path.suffix == ".jpg"),
+            None,
+        )
         
         return {
             "title": info.get("title"),
             "file_path": str(main_file),
             "filename": main_file.name,
+            "file_size": file_size,
+            "thumbnail_path": thumbnail_path,
             "duration": info.get("duration"),
             "thumbnail": info.get("thumbnail"),
              "width": info.get("width"),
@@ -1083,7 +1186,7 @@ async def process_download(job_id: str, url: str, quality: Optional[str], format
             {
                 "filename": result["filename"],
                 "path": result["file_path"],
-                "size": os.path.getsize(result["file_path"]),
+                "size": result["file_size"],
                 "download_url": f"/download/file/{result['filename']}"
             }
         ]
@@ -1323,32 +1426,31 @@ async def stream_video(
             "socket_timeout": 30,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            if info is None:
-                raise HTTPException(status_code=400, detail="Could not extract video information")
-            
-            # Get the best video format URL
-            formats = info.get("formats", [])
-            video_url = None
-            
-            for fmt in formats:
-                if fmt.get("vcodec") != "none" and fmt.get("format_id"):
-                    video_url = fmt.get("url")
-                    if video_url:
-                        break
-            
-            if not video_url:
-                raise HTTPException(status_code=400, detail="No video URL found for streaming")
-            
-            # Return redirect to the video URL for streaming
-            return RedirectResponse(
-                url=video_url,
-                status_code=307,
-                headers={"Cache-Control": "no-cache, no-store, must-revalidate"}
-            )
-            
+        info = await extract_info(url, ydl_opts)
+        
+        if info is None:
+            raise HTTPException(status_code=400, detail="Could not extract video information")
+        
+        # Get the best video format URL
+        formats = info.get("formats", [])
+        video_url = None
+        
+        for fmt in formats:
+            if fmt.get("vcodec") != "none" and fmt.get("format_id"):
+                video_url = fmt.get("url")
+                if video_url:
+                    break
+        
+        if not video_url:
+            raise HTTPException(status_code=400, detail="No video URL found for streaming")
+        
+        # Return redirect to the video URL for streaming
+        return RedirectResponse(
+            url=video_url,
+            status_code=307,
+            headers={"Cache-Control": "no-cache, no-store, must-revalidate"}
+        )
+        
     except HTTPException:
         raise
     except Exception as e:
@@ -1372,34 +1474,33 @@ async def get_playlist_info(request: Request, url: str = Query(..., description=
             "ignoreerrors": True,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            if info is None or info.get("_type") != "playlist":
-                raise HTTPException(status_code=400, detail="URL is not a valid playlist")
-            
-            entries = info.get("entries", [])
-            videos = []
-            
-            for idx, entry in enumerate(entries):
-                if entry:
-                    videos.append({
-                        "index": idx,
-                        "id": entry.get("id"),
-                        "title": entry.get("title"),
-                        "duration": entry.get("duration"),
-                        "url": entry.get("url") or f"https://www.youtube.com/watch?v={entry.get('id')}",
-                        "thumbnail": entry.get("thumbnail") or entry.get("thumbnails", [{}])[0].get("url") if entry.get("thumbnails") else None
-                    })
-            
-            return {
-                "playlist_id": info.get("id"),
-                "playlist_title": info.get("title"),
-                "playlist_count": len(videos),
-                "uploader": info.get("uploader"),
-                "videos": videos
-            }
-            
+        info = await extract_info(url, ydl_opts)
+        
+        if info is None or info.get("_type") != "playlist":
+            raise HTTPException(status_code=400, detail="URL is not a valid playlist")
+        
+        entries = info.get("entries", [])
+        videos = []
+        
+        for idx, entry in enumerate(entries):
+            if entry:
+                videos.append({
+                    "index": idx,
+                    "id": entry.get("id"),
+                    "title": entry.get("title"),
+                    "duration": entry.get("duration"),
+                    "url": entry.get("url") or f"https://www.youtube.com/watch?v={entry.get('id')}",
+                    "thumbnail": entry.get("thumbnail") or entry.get("thumbnails", [{}])[0].get("url") if entry.get("thumbnails") else None
+                })
+        
+        return {
+            "playlist_id": info.get("id"),
+            "playlist_title": info.get("title"),
+            "playlist_count": len(videos),
+            "uploader": info.get("uploader"),
+            "videos": videos
+        }
+        
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting playlist info: {str(e)}")
 
@@ -1496,58 +1597,57 @@ async def process_playlist_download(job_id: str, url: str, quality: Optional[str
             "ignoreerrors": True,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            if info is None:
-                jobs[job_id]["status"] = "failed"
-                jobs[job_id]["error"] = "Could not extract playlist info"
-                return
-            
-            entries = info.get("entries", [])
+        info = await extract_info(url, ydl_opts)
+        
+        if info is None:
+            jobs[job_id]["status"] = "failed"
+            jobs[job_id]["error"] = "Could not extract playlist info"
+            return
+        
+        entries = info.get("entries", [])
+        
+        if indices:
+            entries_to_download = [(i, entries[i]) for i in indices if i < len(entries) and entries[i]]
+        else:
+            entries_to_download = [(i, e) for i, e in enumerate(entries) if e]
+        
+        total = len(entries_to_download)
+        jobs[job_id]["total_videos"] = total
+        
+        for idx, (video_idx, entry) in enumerate(entries_to_download):
+            video_url = entry.get("url") or f"https://www.youtube.com/watch?v={entry.get('id')}"
             
-            if indices:
-                entries_to_download = [(i, entries[i]) for i in indices if i < len(entries) and entries[i]]
-            else:
-                entries_to_download = [(i, e) for i, e in enumerate(entries) if e]
+            file_id = str(uuid.uuid4())[:8]
+            output_template = str(DOWNLOAD_DIR / f"{file_id}_%(title)s.%(ext)s")
             
-            total = len(entries_to_download)
-            jobs[job_id]["total_videos"] = total
+            format_str = format_id if format_id else get_format_string(quality, download_type)
+            download_opts = get_yt_dlp_opts(output_template, format_str, audio_format)
             
-            for idx, (video_idx, entry) in enumerate(entries_to_download):
-                video_url = entry.get("url") or f"https://www.youtube.com/watch?v={entry.get('id')}"
-                
-                file_id = str(uuid.uuid4())[:8]
-                output_template = str(DOWNLOAD_DIR / f"{file_id}_%(title)s.%(ext)s")
-                
-                format_str = format_id if format_id else get_format_string(quality, download_type)
-                download_opts = get_yt_dlp_opts(output_template, format_str, audio_format)
+            try:
+                with yt_dlp.YoutubeDL(download_opts) as dl:
+                    dl.download([video_url])
                 
-                try:
-                    with yt_dlp.YoutubeDL(download_opts) as dl:
-                        dl.download([video_url])
-                    
-                    downloaded_files = list(DOWNLOAD_DIR.glob(f"{file_id}_*"))
-                    for f in downloaded_files:
-                        jobs[job_id]["files"].append({
-                            "filename": f.name,
-                            "path": str(f),
-                            "size": f.stat().st_size,
-                            "download_url": f"/download/file/{f.name}",
-                            "video_index": video_idx,
-                            "title": entry.get("title")
-                        })
-                except Exception as e:
-                    jobs[job_id].setdefault("errors", []).append({
+                downloaded_files = list(DOWNLOAD_DIR.glob(f"{file_id}_*"))
+                for f in downloaded_files:
+                    jobs[job_id]["files"].append({
+                        "filename": f.name,
+                        "path": str(f),
+                        "size": f.stat().st_size,
+                        "download_url": f"/download/file/{f.name}",
                         "video_index": video_idx,
-                        "title": entry.get("title"),
-                        "error": str(e)
+                        "title": entry.get("title")
                     })
-                
-                jobs[job_id]["progress"] = int(((idx + 1) / total) * 100)
-            
-            jobs[job_id]["status"] = "completed"
+            except Exception as e:
+                jobs[job_id].setdefault("errors", []).append({
+                    "video_index": video_idx,
+                    "title": entry.get("title"),
+                    "error": str(e)
+                })
             
+            jobs[job_id]["progress"] = int(((idx + 1) / total) * 100)
+        
+        jobs[job_id]["status"] = "completed"
+        
     except Exception as e:
         jobs[job_id]["status"] = "failed"
         jobs[job_id]["error"] = str(e)
@@ -1571,43 +1671,42 @@ async def get_subtitles_info(request: Request, url: str = Query(...), lang: str
             "skip_download": True,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            if info is None:
-                raise HTTPException(status_code=400, detail="Could not extract video info")
+        info = await extract_info(url, ydl_opts)
+        
+        if info is None:
+            raise HTTPException(status_code=400, detail="Could not extract video info")
+        
+        subtitles = info.get("subtitles", {})
+        auto_subs = info.get("automatic_captions", {})
+        
+        if lang == "all":
+            return {
+                "video_id": info.get("id"),
+                "title": info.get("title"),
+                "manual_subtitles": list(subtitles.keys()),
+                "auto_generated_subtitles": list(auto_subs.keys()),
+                "subtitle_details": {
+                    lang: [{"ext": s.get("ext"), "url": s.get("url")} for s in subs]
+                    for lang, subs in subtitles.items()
+                },
+                "auto_subtitle_details": {
+                    lang: [{"ext": s.get("ext"), "url": s.get("url")} for s in subs]
+                    for lang, subs in auto_subs.items()
+                }
+            }
+        else:
+            sub_info = subtitles.get(lang) or auto_subs.get(lang)
+            if not sub_info:
+                raise HTTPException(status_code=404, detail=f"Subtitles for language '{lang}' not found")
             
-            subtitles = info.get("subtitles", {})
-            auto_subs = info.get("automatic_captions", {})
+            return {
+                "video_id": info.get("id"),
+                "title": info.get("title"),
+                "language": lang,
+                "is_auto_generated": lang in auto_subs and lang not in subtitles,
+                "formats": [{"ext": s.get("ext"), "url": s.get("url")} for s in sub_info]
+            }
             
-            if lang == "all":
-                return {
-                    "video_id": info.get("id"),
-                    "title": info.get("title"),
-                    "manual_subtitles": list(subtitles.keys()),
-                    "auto_generated_subtitles": list(auto_subs.keys()),
-                    "subtitle_details": {
-                        lang: [{"ext": s.get("ext"), "url": s.get("url")} for s in subs]
-                        for lang, subs in subtitles.items()
-                    },
-                    "auto_subtitle_details": {
-                        lang: [{"ext": s.get("ext"), "url": s.get("url")} for s in subs]
-                        for lang, subs in auto_subs.items()
-                    }
-                }
-            else:
-                sub_info = subtitles.get(lang) or auto_subs.get(lang)
-                if not sub_info:
-                    raise HTTPException(status_code=404, detail=f"Subtitles for language '{lang}' not found")
-                
-                return {
-                    "video_id": info.get("id"),
-                    "title": info.get("title"),
-                    "language": lang,
-                    "is_auto_generated": lang in auto_subs and lang not in subtitles,
-                    "formats": [{"ext": s.get("ext"), "url": s.get("url")} for s in sub_info]
-                }
-                
     except HTTPException:
         raise
     except Exception as e:
@@ -1683,36 +1782,35 @@ async def get_thumbnail(
             "no_warnings": True,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            if info is None:
-                raise HTTPException(status_code=400, detail="Could not extract video info")
-            
-            video_id = info.get("id")
-            thumbnails = info.get("thumbnails", [])
-            
-            quality_map = {
-                "maxres": f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg",
-                "hq": f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg",
-                "mq": f"https://img.youtube.com/vi/{video_id}/mqdefault.jpg",
-                "sd": f"https://img.youtube.com/vi/{video_id}/sddefault.jpg",
-                "default": f"https://img.youtube.com/vi/{video_id}/default.jpg",
-            }
-            
-            thumbnail_url = quality_map.get(quality, thumbnails[-1].get("url") if thumbnails else None)
-            
-            if not thumbnail_url:
-                raise HTTPException(status_code=404, detail="Thumbnail not found")
-            
-            return {
-                "video_id": video_id,
-                "title": info.get("title"),
-                "quality": quality,
-                "thumbnail_url": thumbnail_url,
-                "all_thumbnails": [{"quality": t.get("id"), "url": t.get("url")} for t in thumbnails[-5:]]
-            }
-            
+        info = await extract_info(url, ydl_opts)
+        
+        if info is None:
+            raise HTTPException(status_code=400, detail="Could not extract video info")
+        
+        video_id = info.get("id")
+        thumbnails = info.get("thumbnails", [])
+        
+        quality_map = {
+            "maxres": f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg",
+            "hq": f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg",
+            "mq": f"https://img.youtube.com/vi/{video_id}/mqdefault.jpg",
+            "sd": f"https://img.youtube.com/vi/{video_id}/sddefault.jpg",
+            "default": f"https://img.youtube.com/vi/{video_id}/default.jpg",
+        }
+        
+        thumbnail_url = quality_map.get(quality, thumbnails[-1].get("url") if thumbnails else None)
+        
+        if not thumbnail_url:
+            raise HTTPException(status_code=404, detail="Thumbnail not found")
+        
+        return {
+            "video_id": video_id,
+            "title": info.get("title"),
+            "quality": quality,
+            "thumbnail_url": thumbnail_url,
+            "all_thumbnails": [{"quality": t.get("id"), "url": t.get("url")} for t in thumbnails[-5:]]
+        }
+        
     except HTTPException:
         raise
     except Exception as e:
@@ -2042,20 +2140,19 @@ async def instagram_get_post_info(
             "ignoreerrors": True,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(normalized_url, download=False)
-            
-            if info is None:
-                raise HTTPException(
-                    status_code=404, 
-                    detail="Post not found. It may be private, deleted, or the URL is invalid."
-                )
-            
-            return {
-                "success": True,
-                **extract_instagram_post_info(info)
-            }
-            
+        info = await extract_info(normalized_url, ydl_opts)
+        
+        if info is None:
+            raise HTTPException(
+                status_code=404, 
+                detail="Post not found. It may be private, deleted, or the URL is invalid."
+            )
+        
+        return {
+            "success": True,
+            **extract_instagram_post_info(info)
+        }
+        
     except yt_dlp.utils.DownloadError as e:
         error_msg = str(e).lower()
         if "private" in error_msg:
@@ -2093,20 +2190,19 @@ async def instagram_get_reel_info(
             "extract_flat": False,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(normalized_url, download=False)
-            
-            if info is None:
-                raise HTTPException(
-                    status_code=404, 
-                    detail="Reel not found. It may be private, deleted, or the URL is invalid."
-                )
-            
-            return {
-                "success": True,
-                **extract_instagram_reel_info(info)
-            }
-            
+        info = await extract_info(normalized_url, ydl_opts)
+        
+        if info is None:
+            raise HTTPException(
+                status_code=404, 
+                detail="Reel not found. It may be private, deleted, or the URL is invalid."
+            )
+        
+        return {
+            "success": True,
+            **extract_instagram_reel_info(info)
+        }
+        
     except yt_dlp.utils.DownloadError as e:
         error_msg = str(e).lower()
         if "private" in error_msg:
@@ -2143,25 +2239,24 @@ async def instagram_get_story_info(
             "ignoreerrors": True,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(stories_url, download=False)
-            
-            if info is None:
-                return {
-                    "success": True,
-                    "type": "stories",
-                    "username": username.strip().lstrip('@'),
-                    "has_active_stories": False,
-                    "active_stories_count": 0,
-                    "stories": [],
-                    "message": "No active stories found or account may be private."
-                }
-            
+        info = await extract_info(stories_url, ydl_opts)
+        
+        if info is None:
             return {
                 "success": True,
-                **extract_instagram_story_info(info)
+                "type": "stories",
+                "username": username.strip().lstrip('@'),
+                "has_active_stories": False,
+                "active_stories_count": 0,
+                "stories": [],
+                "message": "No active stories found or account may be private."
             }
-            
+        
+        return {
+            "success": True,
+            **extract_instagram_story_info(info)
+        }
+        
     except yt_dlp.utils.DownloadError as e:
         error_msg = str(e).lower()
         if "private" in error_msg:
@@ -2205,35 +2300,34 @@ async def instagram_get_profile_info(
             "playlistend": 12,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(profile_url, download=False)
-            
-            if info is None:
-                raise HTTPException(status_code=404, detail="Profile not found.")
-            
-            entries = info.get("entries", [])
-            recent_posts = []
-            for entry in entries[:12]:
-                if entry:
-                    recent_posts.append({
-                        "id": entry.get("id"),
-                        "title": entry.get("title"),
-                        "url": entry.get("url") or entry.get("webpage_url"),
-                        "thumbnail": entry.get("thumbnail"),
-                        "duration": entry.get("duration"),
-                    })
-            
-            return {
-                "success": True,
-                "type": "profile",
-                "username": info.get("uploader") or info.get("channel") or username.strip().lstrip('@'),
-                "user_id": info.get("uploader_id") or info.get("channel_id"),
-                "profile_url": profile_url,
-                "total_posts": info.get("playlist_count") or len(entries),
-                "recent_posts": recent_posts,
-                "recent_posts_count": len(recent_posts),
-            }
-            
+        info = await extract_info(profile_url, ydl_opts)
+        
+        if info is None:
+            raise HTTPException(status_code=404, detail="Profile not found.")
+        
+        entries = info.get("entries", [])
+        recent_posts = []
+        for entry in entries[:12]:
+            if entry:
+                recent_posts.append({
+                    "id": entry.get("id"),
+                    "title": entry.get("title"),
+                    "url": entry.get("url") or entry.get("webpage_url"),
+                    "thumbnail": entry.get("thumbnail"),
+                    "duration": entry.get("duration"),
+                })
+        
+        return {
+            "success": True,
+            "type": "profile",
+            "username": info.get("uploader") or info.get("channel") or username.strip().lstrip('@'),
+            "user_id": info.get("uploader_id") or info.get("channel_id"),
+            "profile_url": profile_url,
+            "total_posts": info.get("playlist_count") or len(entries),
+            "recent_posts": recent_posts,
+            "recent_posts_count": len(recent_posts),
+        }
+        
     except yt_dlp.utils.DownloadError as e:
         error_msg = str(e).lower()
         if "private" in error_msg:
@@ -2272,36 +2366,35 @@ async def instagram_get_profile_posts(
             "playlistend": limit,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(profile_url, download=False)
-            
-            if info is None:
-                raise HTTPException(status_code=404, detail="Profile not found.")
-            
-            entries = info.get("entries", [])
-            posts = []
-            for idx, entry in enumerate(entries[:limit]):
-                if entry:
-                    posts.append({
-                        "index": idx,
-                        "post_id": entry.get("id"),
-                        "title": entry.get("title"),
-                        "url": entry.get("url") or entry.get("webpage_url"),
-                        "thumbnail": entry.get("thumbnail"),
-                        "duration": entry.get("duration"),
-                        "is_video": entry.get("duration") is not None,
-                    })
-            
-            return {
-                "success": True,
-                "type": "profile_posts",
-                "username": info.get("uploader") or username.strip().lstrip('@'),
-                "total_posts": info.get("playlist_count") or len(entries),
-                "returned_count": len(posts),
-                "limit": limit,
-                "posts": posts,
-            }
-            
+        info = await extract_info(profile_url, ydl_opts)
+        
+        if info is None:
+            raise HTTPException(status_code=404, detail="Profile not found.")
+        
+        entries = info.get("entries", [])
+        posts = []
+        for idx, entry in enumerate(entries[:limit]):
+            if entry:
+                posts.append({
+                    "index": idx,
+                    "post_id": entry.get("id"),
+                    "title": entry.get("title"),
+                    "url": entry.get("url") or entry.get("webpage_url"),
+                    "thumbnail": entry.get("thumbnail"),
+                    "duration": entry.get("duration"),
+                    "is_video": entry.get("duration") is not None,
+                })
+        
+        return {
+            "success": True,
+            "type": "profile_posts",
+            "username": info.get("uploader") or username.strip().lstrip('@'),
+            "total_posts": info.get("playlist_count") or len(entries),
+            "returned_count": len(posts),
+            "limit": limit,
+            "posts": posts,
+        }
+        
     except HTTPException:
         raise
     except Exception as e:
@@ -2634,32 +2727,31 @@ async def instagram_get_post_stats(
             "no_warnings": True,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(normalized_url, download=False)
-            
-            if info is None:
-                raise HTTPException(status_code=404, detail="Post not found.")
-            
-            likes = info.get("like_count", 0)
-            comments = info.get("comment_count", 0)
-            views = info.get("view_count", 0)
-            
-            total_engagement = likes + comments
-            
-            return {
-                "success": True,
-                "type": "post_statistics",
-                "post_id": info.get("id"),
-                "shortcode": extract_instagram_shortcode(info.get("webpage_url", "")),
-                "owner_username": info.get("uploader") or info.get("channel"),
-                "statistics": {
-                    "likes_count": likes,
-                    "comments_count": comments,
-                    "view_count": views,
-                    "total_engagement": total_engagement,
-                },
-            }
-            
+        info = await extract_info(normalized_url, ydl_opts)
+        
+        if info is None:
+            raise HTTPException(status_code=404, detail="Post not found.")
+        
+        likes = info.get("like_count", 0)
+        comments = info.get("comment_count", 0)
+        views = info.get("view_count", 0)
+        
+        total_engagement = likes + comments
+        
+        return {
+            "success": True,
+            "type": "post_statistics",
+            "post_id": info.get("id"),
+            "shortcode": extract_instagram_shortcode(info.get("webpage_url", "")),
+            "owner_username": info.get("uploader") or info.get("channel"),
+            "statistics": {
+                "likes_count": likes,
+                "comments_count": comments,
+                "view_count": views,
+                "total_engagement": total_engagement,
+            },
+        }
+        
     except HTTPException:
         raise
     except Exception as e:
@@ -2686,34 +2778,33 @@ async def instagram_get_reel_stats(
             "no_warnings": True,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(normalized_url, download=False)
-            
-            if info is None:
-                raise HTTPException(status_code=404, detail="Reel not found.")
-            
-            views = info.get("view_count", 0)
-            likes = info.get("like_count", 0)
-            comments = info.get("comment_count", 0)
-            duration = info.get("duration", 0)
-            
-            total_engagement = likes + comments
-            
-            return {
-                "success": True,
-                "type": "reel_statistics",
-                "reel_id": info.get("id"),
-                "shortcode": extract_instagram_shortcode(info.get("webpage_url", "")),
-                "owner_username": info.get("uploader") or info.get("channel"),
-                "duration_seconds": duration,
-                "statistics": {
-                    "view_count": views,
-                    "likes_count": likes,
-                    "comments_count": comments,
-                    "total_engagement": total_engagement,
-                },
-            }
-            
+        info = await extract_info(normalized_url, ydl_opts)
+        
+        if info is None:
+            raise HTTPException(status_code=404, detail="Reel not found.")
+        
+        views = info.get("view_count", 0)
+        likes = info.get("like_count", 0)
+        comments = info.get("comment_count", 0)
+        duration = info.get("duration", 0)
+        
+        total_engagement = likes + comments
+        
+        return {
+            "success": True,
+            "type": "reel_statistics",
+            "reel_id": info.get("id"),
+            "shortcode": extract_instagram_shortcode(info.get("webpage_url", "")),
+            "owner_username": info.get("uploader") or info.get("channel"),
+            "duration_seconds": duration,
+            "statistics": {
+                "view_count": views,
+                "likes_count": likes,
+                "comments_count": comments,
+                "total_engagement": total_engagement,
+            },
+        }
+        
     except HTTPException:
         raise
     except Exception as e:
@@ -2730,7 +2821,7 @@ async def process_instagram_download(
     """Background task to process Instagram post/reel download."""
     try:
         jobs[job_id]["status"] = "processing"
-        logger.info(f"Starting Instagram download for job {job_id}: {url}")
+        logger.info("Starting Instagram download for job %s: %s", job_id, url)
 
         file_id = str(uuid.uuid4())[:8]
         output_template = str(INSTAGRAM_DOWNLOAD_DIR / f"{file_id}_%(title)s.%(ext)s")
@@ -2747,10 +2838,10 @@ async def process_instagram_download(
                 if total > 0:
                     progress = int((downloaded / total) * 100)
                     jobs[job_id]["progress"] = progress
-                    logger.info(f"Instagram download progress for job {job_id}: {progress}%")
+                    logger.info("Instagram download progress for job %s: %s%%", job_id, progress)
             elif d["status"] == "finished":
                 jobs[job_id]["progress"] = 100
-                logger.info(f"Instagram download finished for job {job_id}")
+                logger.info("Instagram download finished for job %s", job_id)
 
         ydl_opts["progress_hooks"] = [progress_hook]
 
@@ -2771,16 +2862,16 @@ async def process_instagram_download(
                 ]
                 jobs[job_id]["status"] = "completed"
                 jobs[job_id]["title"] = info.get("title") or info.get("description", "")[:50]
-                logger.info(f"Instagram download completed for job {job_id}: {jobs[job_id]['title']}")
+                logger.info("Instagram download completed for job %s: %s", job_id, jobs[job_id]['title'])
             else:
                 jobs[job_id]["status"] = "failed"
                 jobs[job_id]["error"] = "Download failed - could not extract content"
-                logger.error(f"Instagram download failed for job {job_id}: could not extract content")
+                logger.error("Instagram download failed for job %s: could not extract content", job_id)
 
     except Exception as e:
         jobs[job_id]["status"] = "failed"
         jobs[job_id]["error"] = str(e)
-        logger.error(f"Instagram download failed for job {job_id}: {str(e)}")
+        logger.error("Instagram download failed for job %s: %s", job_id, e)
 
 
 async def process_instagram_story_download(
@@ -2995,7 +3086,7 @@ app.mount("/ui", StaticFiles(directory="static", html=True), name="static")
 @app.on_event("shutdown")
 async def shutdown_event():
     """Clean up on shutdown."""
-    pass
+    await flush_history()
 
 
 if __name__ == "__main__":
@@ -847,8 +847,9 @@ function connectWebSocket() {
     
     websocket.onmessage = function(event) {
         try {
-            const logData = JSON.parse(event.data);
-            addLogEntry(logData.message, logData.level, logData.source);
+            // Entries arrive batched: {"type": "logs", "data": [entry, ...]}
+            const payload = JSON.parse(event.data);
+            payload.data.forEach(logData => addLogEntry(logData.message, logData.level, logData.source));
         } catch (error) {
             console.error('Error parsing log message:', error);
         }